@@ -1,12 +1,17 @@
 # dashboard.py
 import streamlit as st
 import pandas as pd
+import numpy as np
 import sqlite3
-import plotly.express as px
 import plotly.graph_objects as go
 from datetime import datetime, timezone # Added timezone
 import time # For sleep
+import threading
 import traceback # For detailed error logging in sidebar
+try:
+    import adbc_driver_sqlite.dbapi as sqlite_adbc # Optional: Arrow-backed reads for the long chart histories
+except ImportError:
+    sqlite_adbc = None
 
 # --- IMPORT YOUR MODULES ---
 import thresholds_config as th 
@@ -22,58 +27,225 @@ st.title("📈 Crypto Market Cycle Top Detection Dashboard")
 
 
 # --- DATABASE UTILITIES ---
-def fetch_from_db_dash(query): 
-    conn = sqlite3.connect(DB_PATH)
-    try:
-        df = pd.read_sql_query(query, conn)
-    except Exception as e:
-        st.error(f"Dashboard DB error: {e} for query: {query}")
-        if "timestamp" in query.lower():
-             return pd.DataFrame(columns=['timestamp'])
-        elif "date" in query.lower():
-             return pd.DataFrame(columns=['date'])
-        return pd.DataFrame()
-    finally:
-        conn.close()
-    
+@st.cache_resource
+def get_conn():
+    """Shared read-only connection, opened once per server process and reused by every query.
+    Schema setup stays with main.py / the refresh button; the dashboard itself never writes."""
+    conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, check_same_thread=False)
+    conn.execute("PRAGMA query_only=1")
+    # Read-side tuning only; journal_mode=WAL is set by the writer in init_db (needs a writable handle)
+    conn.execute("PRAGMA mmap_size=268435456") # 256 MB of the file served from mapped pages
+    conn.execute("PRAGMA cache_size=-65536")   # 64 MB page cache
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+_ARROW_LOCK = threading.Lock()
+
+@st.cache_resource
+def get_arrow_conn():
+    """Read-only ADBC connection for columnar fetches; statements on it are serialized by _ARROW_LOCK."""
+    return data_fetcher.open_arrow_reader(DB_PATH)
+
+def _fetch_columnar(query, params):
+    with _ARROW_LOCK:
+        cur = get_arrow_conn().cursor()
+        try:
+            cur.execute(query, params or None)
+            return cur.fetch_arrow_table().to_pandas()
+        finally:
+            cur.close()
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _query_frame(query: str, params: tuple = (), columnar: bool = False) -> pd.DataFrame:
+    """Cached body of fetch_from_db_dash. DB errors propagate so a failed read is never cached."""
+    if columnar and sqlite_adbc is not None:
+        df = _fetch_columnar(query, params)
+    else:
+        cur = get_conn().execute(query, params)
+        rows = cur.fetchall()
+        cols = [d[0] for d in cur.description]
+        df = pd.DataFrame.from_records(rows, columns=cols)
+
     if not df.empty:
         if 'timestamp' in df.columns:
-            df['date'] = pd.to_datetime(df['timestamp'], unit='s', utc=True)
+            df['date'] = pd.to_datetime(df['timestamp'], unit='s')
         elif 'date' in df.columns and not pd.api.types.is_datetime64_any_dtype(df['date']):
             try:
-                df['date'] = pd.to_datetime(df['date']) 
+                df['date'] = pd.to_datetime(df['date'], format='%Y-%m-%d', errors='coerce', cache=True) # Text dates are stored as YYYY-MM-DD
             except Exception as e:
                 print(f"Could not convert date column: {e} in query {query}")
                 df['date'] = pd.NaT # Use NaT for failed conversions
     return df
 
-# --- Risk Color Coding Function ---
-def get_risk_color_html(value, high_threshold, medium_threshold, low_is_good=True, value_format=".2f"):
-    color = "green" 
-    risk_level = "Low"
-    if value is None or pd.isna(value):
-        return f"<span style='color:grey; font-weight:bold;'>Data N/A</span>"
+def fetch_from_db_dash(query: str, params: tuple = (), columnar: bool = False) -> pd.DataFrame:
+    """Runs a query into a DataFrame. columnar=True (for long histories) fetches an Arrow
+    table via ADBC when installed, avoiding a Python object per cell."""
     try:
-        value_float = float(value)
-        # Ensure thresholds are floats for comparison, handle None from config if it ever occurs
-        high_threshold = float(high_threshold) if high_threshold is not None else (float('-inf') if not low_is_good else float('inf'))
-        medium_threshold = float(medium_threshold) if medium_threshold is not None else (float('-inf') if not low_is_good else float('inf'))
-
-    except ValueError:
-        return f"<span style='color:grey; font-weight:bold;'>Invalid Value ({value})</span>"
-
-    if low_is_good: 
-        if value_float >= high_threshold:
-            color = "red"; risk_level = "High"
-        elif value_float >= medium_threshold:
-            color = "orange"; risk_level = "Medium"
-    else: # Lower values are riskier
-        if value_float <= high_threshold: # For this logic, high_threshold is the "very low" point for red
-            color = "red"; risk_level = "High (Risk)" 
-        elif value_float <= medium_threshold:
-            color = "orange"; risk_level = "Medium (Risk)"
-            
-    return f"<span style='color:{color}; font-weight:bold;'>{risk_level} ({value_float:{value_format}})</span>"
+        return _query_frame(query, params, columnar)
+    except Exception as e: # e.g. "database is locked" during an update; only this render falls back
+        st.error(f"Dashboard DB error: {e} for query: {query}")
+        if "timestamp" in query.lower():
+             return pd.DataFrame(columns=['timestamp'])
+        elif "date" in query.lower():
+             return pd.DataFrame(columns=['date'])
+        return pd.DataFrame()
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _query_history(table: str, columns: tuple, since_ts: int = None) -> pd.DataFrame:
+    """Cached body of fetch_history; raises on read errors like _query_frame."""
+    df = formulas.read_parquet_history(table, list(columns), since_ts)
+    if df is None: # No Parquet mirror (or no pyarrow): columnar read from SQLite instead
+        where, params = ("", ()) if since_ts is None else (" WHERE timestamp >= ?", (since_ts,))
+        return _query_frame(f'SELECT timestamp, {", ".join(columns)} FROM "{table}"{where} ORDER BY timestamp', params, columnar=True)
+    df['date'] = pd.to_datetime(df['timestamp'], unit='s')
+    return df
+
+def fetch_history(table: str, columns: tuple, days: int = None) -> pd.DataFrame:
+    """Chart history of a calculated table (timestamp, date and `columns`) over its last `days` days,
+    read from the calculators' year-partitioned Parquet mirror when it exists."""
+    since_ts = None
+    if days is not None: # Day-aligned so the cache key stays the same all day
+        since_ts = int(pd.Timestamp.now(tz='UTC').normalize().timestamp()) - days * 86400
+    try:
+        return _query_history(table, columns, since_ts)
+    except Exception as e:
+        st.error(f"Dashboard DB error: {e} for history of: {table}")
+        return pd.DataFrame(columns=['timestamp'])
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _query_row(query: str, params: tuple = ()) -> dict:
+    """Cached body of fetch_latest; raises on DB errors like _query_frame."""
+    cur = get_conn().execute(query, params)
+    row = cur.fetchone()
+    return dict(zip([d[0] for d in cur.description], row)) if row else {}
+
+def fetch_latest(query: str, params: tuple = ()) -> dict:
+    """Single-row read as a {column: value} dict, skipping DataFrame construction."""
+    try:
+        return _query_row(query, params)
+    except Exception as e:
+        st.error(f"Dashboard DB error: {e} for query: {query}")
+        return {}
+
+# Latest row of every derived/snapshot table in a single round-trip. Each subselect is one
+# reverse index seek; a NULL *_ts column means that table has no rows yet.
+LATEST_SNAPSHOT_SQL = """
+SELECT
+    pi.timestamp AS pi_ts, pi.sma_111, pi.sma_350_doubled, pi.risk_code AS pi_risk,
+    wma.timestamp AS wma_ts, wma.btc_price AS wma_btc_price, wma.wma_200, wma.risk_code AS wma_risk,
+    dom.timestamp AS dom_ts, dom.dominance,
+    s2f.timestamp AS s2f_ts, s2f.btc_price AS s2f_btc_price, s2f.s2f_price_model, s2f.s2f_ratio, s2f.risk_code AS s2f_risk,
+    puell.timestamp AS puell_ts, puell.puell_multiple, puell.risk_code AS puell_risk
+FROM (SELECT 1)
+LEFT JOIN (SELECT timestamp, sma_111, sma_350_doubled, risk_code FROM pi_cycle_data ORDER BY timestamp DESC LIMIT 1) AS pi
+LEFT JOIN (SELECT timestamp, btc_price, wma_200, risk_code FROM wma_200_data ORDER BY timestamp DESC LIMIT 1) AS wma
+LEFT JOIN (SELECT timestamp, dominance FROM bitcoin_dominance ORDER BY timestamp DESC LIMIT 1) AS dom
+LEFT JOIN (SELECT timestamp, btc_price, s2f_price_model, s2f_ratio, risk_code FROM s2f_data ORDER BY timestamp DESC LIMIT 1) AS s2f
+LEFT JOIN (SELECT timestamp, puell_multiple, risk_code FROM puell_multiple_calculated ORDER BY timestamp DESC LIMIT 1) AS puell
+"""
+
+MACRO_TICKERS = ('SPX', 'Gold', 'DXY', 'US10Y')
+MACRO_LATEST_SQL = (
+    "SELECT ticker, close_price FROM macro_indicators WHERE (ticker, date) IN "
+    "(SELECT ticker, MAX(date) FROM macro_indicators WHERE ticker IN ("
+    + ", ".join("?" * len(MACRO_TICKERS)) + ") GROUP BY ticker)"
+)
+
+LAST_UPDATE_PATH = "data/last_successful_update.txt"
+
+@st.cache_data(ttl=60, show_spinner=False)
+def read_last_update():
+    try:
+        with open(LAST_UPDATE_PATH, "r") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+def _write_last_update(update_time_str):
+    try:
+        with open(LAST_UPDATE_PATH, "w") as f:
+            f.write(update_time_str)
+    except Exception as e:
+        print(f"Could not write last update time: {e}")
+
+def _clear_cache():
+    """Drops cached query results so the next run reads freshly fetched rows."""
+    _query_frame.clear()
+    _query_row.clear()
+    _query_history.clear()
+    read_last_update.clear()
+
+# --- CHARTS ---
+def _col_bytes(col):
+    """Raw buffer of a date or numeric column; cheap to hash as a build_line_chart cache key.
+    Values are float32: ~7 significant digits is plenty on a chart, and it halves the bytes
+    hashed per rerun and the typed arrays plotly ships to the browser."""
+    if pd.api.types.is_datetime64_any_dtype(col):
+        return col.to_numpy('datetime64[ns]').tobytes()
+    return col.to_numpy('float32').tobytes()
+
+@st.cache_resource(show_spinner=False, max_entries=32)
+def build_line_chart(title, x_bytes, traces, hlines=(), yaxis_type=None, legend_title=None):
+    """Builds (once per distinct data) a line chart from _col_bytes buffers.
+
+    traces is a tuple of (name, y_bytes, dash) and hlines a tuple of (y, color, text).
+    Cached as a resource so reruns reuse the Figure object instead of deep-copying it.
+    """
+    x = np.frombuffer(x_bytes, dtype='datetime64[ns]')
+    fig = go.Figure()
+    for name, y_bytes, dash in traces:
+        fig.add_trace(go.Scattergl(x=x, y=np.frombuffer(y_bytes, dtype='float32'), mode='lines', name=name, line=dict(dash=dash)))
+    for y, color, text in hlines:
+        fig.add_hline(y=y, line_dash="dash", line_color=color, annotation_text=text)
+    fig.update_layout(title=title, yaxis_type=yaxis_type, legend_title_text=legend_title)
+    return fig
+
+# --- Risk Classification ---
+# metric -> (medium threshold, high threshold, low_is_good); shared with the calculators' stored risk_code.
+RISK_THRESHOLDS = formulas.RISK_THRESHOLDS
+RISK_COLORS = {-1: 'grey', 0: 'green', 1: 'orange', 2: 'red'}
+
+# Latest risk_code of each indicator from the latest_metrics view, counted per code in SQL. Metrics
+# without a stored code (raw-source metrics, or calculator rows from before risk_code) come back one
+# row each with their value, for classify() below; an empty source counts as NA.
+RISK_COUNTS_SQL = """
+SELECT risk_code, COUNT(*) AS n, NULL AS metric, NULL AS value FROM latest_metrics WHERE risk_code IS NOT NULL GROUP BY risk_code
+UNION ALL
+SELECT NULL, 1, metric, value FROM latest_metrics WHERE risk_code IS NULL
+"""
+
+def classify(metric, value):
+    """Risk code (-1 N/A, 0 green, 1 yellow, 2 red) of a single metric value."""
+    medium, high, low_is_good = RISK_THRESHOLDS[metric]
+    return int(formulas.classify_series(np.nan if value is None else value, medium, high, low_is_good))
+
+def overall_risk_counts():
+    """Red/Yellow/Green/NA indicator counts from RISK_COUNTS_SQL."""
+    counts = dict.fromkeys(RISK_COLORS, 0)
+    for row in fetch_from_db_dash(RISK_COUNTS_SQL).itertuples(index=False):
+        code = classify(row.metric, row.value) if pd.isna(row.risk_code) else int(row.risk_code)
+        counts[code] += int(row.n)
+    return {'Red': counts[2], 'Yellow': counts[1], 'Green': counts[0], 'NA': counts[-1]}
+
+# --- Risk Badges ---
+RISK_LABELS = {0: 'Low', 1: 'Medium', 2: 'High'}
+
+def risk_badge(label, risk, text):
+    """Bold label followed by a native colored badge (same as st.badge) for a risk code."""
+    st.markdown(f"**{label}:** :{RISK_COLORS[risk]}-badge[{text}]")
+
+def metric_risk_badge(label, metric, value, value_format=".2f", risk=None):
+    """Renders a metric value's risk badge. risk is the calculator's stored risk_code; the value is only
+    classified against RISK_THRESHOLDS here when that is missing (rows from before the column existed)."""
+    if risk is None:
+        risk = classify(metric, value)
+    if risk < 0:
+        risk_badge(label, risk, "Data N/A")
+        return
+    risk_level = RISK_LABELS[risk]
+    if risk and not RISK_THRESHOLDS[metric][2]: # Lower values are riskier
+        risk_level += " (Risk)"
+    risk_badge(label, risk, f"{risk_level} ({float(value):{value_format}})")
 
 # --- FUNCTION TO TRIGGER DATA REFRESH ---
 def trigger_data_update_and_calculations():
@@ -94,20 +266,17 @@ def trigger_data_update_and_calculations():
 
     # Step 2: Calculate derived metrics
     st.sidebar.text("Calculating derived metrics...")
-    formulas.calculate_pi_cycle_top()
-    formulas.calculate_200wma()
-    formulas.calculate_s2f_model()
-    formulas.calculate_puell_multiple_alternative()
+    btc_df = formulas._load_btc_prices_cached() # One price read shared by the calculators
+    formulas.calculate_pi_cycle_top(btc_df=btc_df)
+    formulas.calculate_200wma(btc_df=btc_df)
+    formulas.calculate_s2f_model(btc_df=btc_df)
+    formulas.calculate_puell_multiple_alternative(btc_df=btc_df)
     st.sidebar.text("Derived metrics calculation complete.")
     
-    # Store last successful update time
+    # Store last successful update time off the UI thread
     update_time_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    try:
-        with open("data/last_successful_update.txt", "w") as f:
-            f.write(update_time_str)
-        st.sidebar.info(f"[{update_time_str}] Data update cycle finished.")
-    except Exception as e:
-        st.sidebar.warning(f"Could not write last update time: {e}")
+    threading.Thread(target=_write_last_update, args=(update_time_str,), daemon=True).start()
+    st.sidebar.info(f"[{update_time_str}] Data update cycle finished.")
 
 
 # --- SIDEBAR ---
@@ -124,324 +293,318 @@ if st.sidebar.button("Fetch Latest Data & Refresh Dashboard", key="fetch_data_bu
         try:
             trigger_data_update_and_calculations()
             st.sidebar.success("Data refresh cycle complete! Rerunning dashboard...")
+            _clear_cache()
             time.sleep(0.5) 
             st.rerun() 
         except Exception as e:
             st.sidebar.error(f"Error during data refresh: {e}")
             st.sidebar.text_area("Error Details:", value=traceback.format_exc(), height=200)
 
-try:
-    with open("data/last_successful_update.txt", "r") as f:
-        last_update_time_str = f.read().strip()
+last_update_time_str = read_last_update()
+if last_update_time_str is not None:
     st.sidebar.caption(f"Data last successfully fetched via button/manual run: {last_update_time_str}")
-except FileNotFoundError:
+else:
     st.sidebar.caption("Data fetch status: N/A (run 'Fetch Latest Data' or ensure scheduler is active)")
 
 
-# --- Initialize overall_risk_signals for each run ---
-overall_risk_signals = {'Red': 0, 'Yellow': 0, 'Green': 0, 'NA': 0}
-
 # --- DEFINE COLUMNS ONCE for the main layout ---
 col1, col2, col3 = st.columns(3)
 
 # --- METRIC 1: Bitcoin Price & ETH Price ---
-with col1:
+@st.fragment
+def render_market_prices():
     st.subheader("📉 Market Prices (USD)")
-    btc_price_df = fetch_from_db_dash("SELECT * FROM crypto_prices WHERE coin_id = 'bitcoin' ORDER BY timestamp DESC LIMIT 365")
-    eth_price_df = fetch_from_db_dash("SELECT * FROM crypto_prices WHERE coin_id = 'ethereum' ORDER BY timestamp DESC LIMIT 365")
+    btc_price_df = fetch_from_db_dash("SELECT * FROM (SELECT timestamp, price FROM crypto_prices WHERE coin_id = 'bitcoin' ORDER BY timestamp DESC LIMIT 365) ORDER BY timestamp")
+    latest_eth = fetch_latest("SELECT price FROM crypto_prices WHERE coin_id = 'ethereum' ORDER BY timestamp DESC LIMIT 1")
 
     if not btc_price_df.empty:
-        latest_btc_price = btc_price_df.iloc[0]['price']
+        latest_btc_price = btc_price_df.iloc[-1]['price']
         st.metric(label="Bitcoin Price", value=f"${latest_btc_price:,.2f}" if latest_btc_price is not None else "N/A")
         if 'date' in btc_price_df.columns and 'price' in btc_price_df.columns:
-            fig_btc = px.line(btc_price_df.sort_values(by='date'), x='date', y='price', title='BTC Price (Last Year)')
+            fig_btc = build_line_chart('BTC Price (Last Year)', _col_bytes(btc_price_df['date']),
+                                       (('BTC Price', _col_bytes(btc_price_df['price']), None),))
             st.plotly_chart(fig_btc, use_container_width=True)
     else:
         st.write("Bitcoin price data not available.")
-        overall_risk_signals['NA'] +=1
 
-    if not eth_price_df.empty:
-        latest_eth_price = eth_price_df.iloc[0]['price']
-        st.metric(label="Ethereum Price", value=f"${latest_eth_price:,.2f}" if latest_eth_price is not None else "N/A")
+    latest_eth_price = latest_eth.get('price')
+    if latest_eth_price is not None:
+        st.metric(label="Ethereum Price", value=f"${latest_eth_price:,.2f}")
     else:
         st.write("Ethereum price data not available.")
 
+with col1:
+    render_market_prices()
+
 # --- METRIC 2: Fear & Greed Index ---
-with col2:
+@st.fragment
+def render_fear_greed():
     st.subheader("😟 Fear & Greed Index")
-    fg_df = fetch_from_db_dash("SELECT * FROM fear_greed_index ORDER BY timestamp DESC LIMIT 365")
+    fg_df = fetch_from_db_dash("SELECT * FROM (SELECT timestamp, value, value_classification FROM fear_greed_index ORDER BY timestamp DESC LIMIT 365) ORDER BY timestamp")
     if not fg_df.empty:
-        latest_fg = fg_df.iloc[0]
+        latest_fg = fg_df.iloc[-1]
         fg_value = int(latest_fg['value']) if latest_fg['value'] is not None and pd.notna(latest_fg['value']) else None
         fg_classification_api = latest_fg['value_classification']
         
-        color = "grey"; risk_description = "Data N/A"
-        if fg_value is not None:
-            risk_description = fg_classification_api if fg_classification_api else "Neutral" 
-            color = "green"; overall_risk_signals['Green'] += 1 
-            if fg_value >= th.FG_EXTREME_GREED: color = "red"; overall_risk_signals['Red'] += 1; risk_description = "Extreme Greed"
-            elif fg_value >= th.FG_GREED: color = "orange"; overall_risk_signals['Yellow'] += 1; risk_description = "Greed"
-        else: overall_risk_signals['NA'] +=1
+        risk = classify('fear_greed', fg_value)
+        risk_description = {-1: "Data N/A", 0: fg_classification_api if fg_classification_api else "Neutral", 1: "Greed", 2: "Extreme Greed"}[risk]
             
         st.metric(label="Current F&G", value=f"{fg_value if fg_value is not None else 'N/A'} ({fg_classification_api if fg_classification_api else 'N/A'})")
-        st.markdown(f"**Risk Level:** <span style='color:{color}; font-weight:bold;'>{risk_description}</span>", unsafe_allow_html=True)
+        risk_badge("Risk Level", risk, risk_description)
         
         if 'date' in fg_df.columns and 'value' in fg_df.columns:
-            fig_fg = px.line(fg_df.sort_values(by='date'), x='date', y='value', title='Fear & Greed Index (Last Year)')
-            fig_fg.add_hline(y=th.FG_EXTREME_GREED, line_dash="dash", line_color="red", annotation_text="Extreme Greed Zone")
-            fig_fg.add_hline(y=th.FG_GREED, line_dash="dash", line_color="orange", annotation_text="Greed Zone")
+            fig_fg = build_line_chart('Fear & Greed Index (Last Year)', _col_bytes(fg_df['date']),
+                                      (('Fear & Greed', _col_bytes(fg_df['value']), None),),
+                                      hlines=((th.FG_EXTREME_GREED, "red", "Extreme Greed Zone"), (th.FG_GREED, "orange", "Greed Zone")))
             st.plotly_chart(fig_fg, use_container_width=True)
     else:
-        st.write("Fear & Greed data not available."); overall_risk_signals['NA'] +=1
+        st.write("Fear & Greed data not available.")
+
+with col2:
+    render_fear_greed()
 
 # --- METRIC 3: Google Trends ---
-with col3:
+@st.fragment
+def render_google_trends():
     st.subheader("🔍 Google Trends ('Bitcoin')")
-    gt_df = fetch_from_db_dash("SELECT * FROM google_trends ORDER BY date DESC LIMIT 365")
+    gt_df = fetch_from_db_dash("SELECT * FROM (SELECT date, bitcoin_trends FROM google_trends ORDER BY date DESC LIMIT 365) ORDER BY date")
     if not gt_df.empty:
-        latest_gt_val = gt_df.iloc[0]['bitcoin_trends'] if 'bitcoin_trends' in gt_df.columns and not gt_df.empty and pd.notna(gt_df.iloc[0]['bitcoin_trends']) else None
+        latest_gt_val = gt_df.iloc[-1]['bitcoin_trends'] if 'bitcoin_trends' in gt_df.columns and not gt_df.empty and pd.notna(gt_df.iloc[-1]['bitcoin_trends']) else None
         st.metric(label="Latest Trend Score", value=f"{latest_gt_val if latest_gt_val is not None else 'N/A'}")
         
-        color = "grey"; risk_description="Data N/A"
-        if latest_gt_val is not None:
-            risk_description="Low"; color = "green"; overall_risk_signals['Green'] += 1
-            if latest_gt_val >= th.GTRENDS_HIGH_RISK: color = "red"; overall_risk_signals['Red'] += 1; risk_description="High"
-            elif latest_gt_val >= th.GTRENDS_MEDIUM_RISK: color = "orange"; overall_risk_signals['Yellow'] += 1; risk_description="Medium"
-        else: overall_risk_signals['NA'] +=1
+        risk = classify('google_trends', latest_gt_val)
+        risk_description = {-1: "Data N/A", 0: "Low", 1: "Medium", 2: "High"}[risk]
         
-        st.markdown(f"**Retail FOMO Risk:** <span style='color:{color}; font-weight:bold;'>{risk_description}</span>", unsafe_allow_html=True)
+        risk_badge("Retail FOMO Risk", risk, risk_description)
         if 'date' in gt_df.columns and 'bitcoin_trends' in gt_df.columns:
-            fig_gt = px.line(gt_df.sort_values(by='date'), x='date', y='bitcoin_trends', title="Google Trends for 'Bitcoin' (Last Year)")
+            fig_gt = build_line_chart("Google Trends for 'Bitcoin' (Last Year)", _col_bytes(gt_df['date']),
+                                      (('Bitcoin Trends', _col_bytes(gt_df['bitcoin_trends']), None),))
             st.plotly_chart(fig_gt, use_container_width=True)
     else:
-        st.write("Google Trends data not available."); overall_risk_signals['NA'] +=1
+        st.write("Google Trends data not available.")
+
+with col3:
+    render_google_trends()
 
 st.divider()
 col4, col5, col6 = st.columns(3)
 
 # --- METRIC 4: Pi Cycle Top ---
-with col4:
+@st.fragment
+def render_pi_cycle():
     st.subheader("🥧 Pi Cycle Top")
-    pi_df = fetch_from_db_dash("SELECT * FROM pi_cycle_data ORDER BY timestamp DESC LIMIT 1") 
-    
-    if not pi_df.empty:
-        latest_pi = pi_df.iloc[0]
-        current_sma_111 = latest_pi['sma_111'] if 'sma_111' in latest_pi and pd.notna(latest_pi['sma_111']) else None
-        current_sma_350_doubled = latest_pi['sma_350_doubled'] if 'sma_350_doubled' in latest_pi and pd.notna(latest_pi['sma_350_doubled']) else None
+    latest_snapshot = fetch_latest(LATEST_SNAPSHOT_SQL)
+    if latest_snapshot.get('pi_ts') is not None:
+        current_sma_111 = latest_snapshot.get('sma_111')
+        current_sma_350_doubled = latest_snapshot.get('sma_350_doubled')
         
-        color = "grey"; risk_description = "Data N/A"
-        if current_sma_111 is not None and current_sma_350_doubled is not None:
-            risk_description = "Low"; color = "green"; overall_risk_signals['Green'] +=1
-            if current_sma_111 >= current_sma_350_doubled:
-                color = "red"; overall_risk_signals['Red'] +=1; risk_description = "High Risk (CROSSED)"
-            elif current_sma_111 >= (th.PI_CYCLE_APPROACH_FACTOR * current_sma_350_doubled):
-                color = "orange"; overall_risk_signals['Yellow'] +=1; risk_description = "Medium Risk (Approaching)"
-        else: overall_risk_signals['NA'] +=1
+        pi_ratio = None
+        if current_sma_111 is not None and current_sma_350_doubled:
+            pi_ratio = current_sma_111 / current_sma_350_doubled
+        risk = latest_snapshot.get('pi_risk') # Stored by the calculator; classify older rows without one
+        if risk is None:
+            risk = classify('pi_cycle', pi_ratio)
+        risk_description = {-1: "Data N/A", 0: "Low", 1: "Medium Risk (Approaching)", 2: "High Risk (CROSSED)"}[risk]
             
-        st.markdown(f"**Signal:** <span style='color:{color}; font-weight:bold;'>{risk_description}</span>", unsafe_allow_html=True)
+        risk_badge("Signal", risk, risk_description)
         
         sma_111_display = f"{current_sma_111:.0f}" if current_sma_111 is not None else "N/A"
         sma_350_doubled_display = f"{current_sma_350_doubled:.0f}" if current_sma_350_doubled is not None else "N/A"
         st.caption(f"111DMA: {sma_111_display} | 350DMA*2: {sma_350_doubled_display}")
 
-        pi_chart_df = fetch_from_db_dash("SELECT * FROM pi_cycle_data ORDER BY timestamp DESC LIMIT 730")
+        pi_chart_df = fetch_history('pi_cycle_data', ('btc_price', 'sma_111', 'sma_350_doubled'), days=730)
         if not pi_chart_df.empty and 'date' in pi_chart_df and 'btc_price' in pi_chart_df and 'sma_111' in pi_chart_df and 'sma_350_doubled' in pi_chart_df :
-            fig_pi = go.Figure()
-            fig_pi.add_trace(go.Scatter(x=pi_chart_df['date'].sort_values(), y=pi_chart_df['btc_price'], mode='lines', name='BTC Price'))
-            fig_pi.add_trace(go.Scatter(x=pi_chart_df['date'].sort_values(), y=pi_chart_df['sma_111'], mode='lines', name='111DMA'))
-            fig_pi.add_trace(go.Scatter(x=pi_chart_df['date'].sort_values(), y=pi_chart_df['sma_350_doubled'], mode='lines', name='350DMA x 2'))
-            fig_pi.update_layout(title='Pi Cycle Top Indicator (Last ~2 Years)', legend_title_text='Metrics')
+            fig_pi = build_line_chart('Pi Cycle Top Indicator (Last ~2 Years)', _col_bytes(pi_chart_df['date']),
+                                      (('BTC Price', _col_bytes(pi_chart_df['btc_price']), None),
+                                       ('111DMA', _col_bytes(pi_chart_df['sma_111']), None),
+                                       ('350DMA x 2', _col_bytes(pi_chart_df['sma_350_doubled']), None)),
+                                      legend_title='Metrics')
             st.plotly_chart(fig_pi, use_container_width=True)
         else:
             st.write("Chart data for Pi Cycle not available.") # This message might appear if table is empty.
     else:
-        st.write("Pi Cycle Top data not available."); overall_risk_signals['NA'] +=1
+        st.write("Pi Cycle Top data not available.")
+
+with col4:
+    render_pi_cycle()
 
 # --- METRIC 5: 200 Week MA ---
-with col5:
+@st.fragment
+def render_wma_200():
     st.subheader("🌊 Bitcoin Price vs. 200 Week MA")
-    wma_df = fetch_from_db_dash("SELECT * FROM wma_200_data ORDER BY timestamp DESC LIMIT 1") 
-    
-    if not wma_df.empty:
-        latest_wma = wma_df.iloc[0]
-        btc_price_for_wma = latest_wma['btc_price'] if 'btc_price' in latest_wma and pd.notna(latest_wma['btc_price']) else None
-        wma200_value = latest_wma['wma_200'] if 'wma_200' in latest_wma and pd.notna(latest_wma['wma_200']) else None
+    latest_snapshot = fetch_latest(LATEST_SNAPSHOT_SQL)
+    if latest_snapshot.get('wma_ts') is not None:
+        btc_price_for_wma = latest_snapshot.get('wma_btc_price')
+        wma200_value = latest_snapshot.get('wma_200')
         
         price_to_wma_ratio = None
         if wma200_value and wma200_value > 0 and btc_price_for_wma is not None: 
             price_to_wma_ratio = btc_price_for_wma / wma200_value
         
-        risk_html = get_risk_color_html(price_to_wma_ratio, th.WMA200_PRICE_RATIO_HIGH, th.WMA200_PRICE_RATIO_MEDIUM)
-        st.markdown(f"**BTC Price / 200WMA Ratio:** {risk_html}", unsafe_allow_html=True)
-        
-        if price_to_wma_ratio is not None:
-            if price_to_wma_ratio >= th.WMA200_PRICE_RATIO_HIGH: overall_risk_signals['Red'] +=1
-            elif price_to_wma_ratio >= th.WMA200_PRICE_RATIO_MEDIUM: overall_risk_signals['Yellow'] +=1
-            else: overall_risk_signals['Green'] +=1
-        else:
-            overall_risk_signals['NA'] +=1 
+        metric_risk_badge("BTC Price / 200WMA Ratio", 'wma_200', price_to_wma_ratio, risk=latest_snapshot.get('wma_risk'))
         
         btc_price_display = f"${btc_price_for_wma:,.0f}" if btc_price_for_wma is not None else "N/A"
         wma200_display = f"${wma200_value:,.0f}" if wma200_value is not None else "N/A (Insufficient History)"
         st.caption(f"Latest Weekly Price: {btc_price_display} | 200WMA: {wma200_display}")
         
-        wma_chart_df = fetch_from_db_dash("SELECT * FROM wma_200_data ORDER BY timestamp") 
+        wma_chart_df = fetch_history('wma_200_data', ('btc_price', 'wma_200'))
         if not wma_chart_df.empty and 'date' in wma_chart_df and 'btc_price' in wma_chart_df and 'wma_200' in wma_chart_df:
-            fig_wma = go.Figure()
-            fig_wma.add_trace(go.Scatter(x=wma_chart_df['date'].sort_values(), y=wma_chart_df['btc_price'], mode='lines', name='BTC Price (Weekly Close)'))
-            fig_wma.add_trace(go.Scatter(x=wma_chart_df['date'].sort_values(), y=wma_chart_df['wma_200'], mode='lines', name='200 Week MA'))
-            fig_wma.update_layout(title='Bitcoin Price vs 200 Week MA', yaxis_type="log")
+            fig_wma = build_line_chart('Bitcoin Price vs 200 Week MA', _col_bytes(wma_chart_df['date']),
+                                       (('BTC Price (Weekly Close)', _col_bytes(wma_chart_df['btc_price']), None),
+                                        ('200 Week MA', _col_bytes(wma_chart_df['wma_200']), None)),
+                                       yaxis_type="log")
             st.plotly_chart(fig_wma, use_container_width=True)
         else:
              st.write("Chart data for 200WMA not available (likely insufficient history).")
     else:
-        st.write("200WMA data not available (likely due to insufficient historical price data)."); overall_risk_signals['NA'] +=1
+        st.write("200WMA data not available (likely due to insufficient historical price data).")
+
+with col5:
+    render_wma_200()
 
 # --- METRIC 6: Bitcoin Dominance ---
-with col6:
+@st.fragment
+def render_dominance():
     st.subheader("👑 Bitcoin Dominance")
-    dom_df = fetch_from_db_dash("SELECT * FROM bitcoin_dominance ORDER BY timestamp DESC LIMIT 1") 
-    if not dom_df.empty:
-        latest_dominance = dom_df.iloc[0]['dominance'] if 'dominance' in dom_df.columns and pd.notna(dom_df.iloc[0]['dominance']) else None
-        risk_html = get_risk_color_html(latest_dominance, th.DOMINANCE_FROTH_HIGH, th.DOMINANCE_FROTH_MEDIUM, low_is_good=False, value_format=".2f") 
+    latest_snapshot = fetch_latest(LATEST_SNAPSHOT_SQL)
+    if latest_snapshot.get('dom_ts') is not None:
+        latest_dominance = latest_snapshot.get('dominance')
         st.metric(label="Current BTC.D", value=f"{latest_dominance:.2f}%" if latest_dominance is not None else "N/A")
-        st.markdown(f"**Market Froth Risk (Low BTC.D):** {risk_html}", unsafe_allow_html=True)
-
-        if latest_dominance is not None:
-            if latest_dominance <= th.DOMINANCE_FROTH_HIGH: overall_risk_signals['Red'] +=1
-            elif latest_dominance <= th.DOMINANCE_FROTH_MEDIUM: overall_risk_signals['Yellow'] +=1
-            else: overall_risk_signals['Green'] +=1
-        else:
-            overall_risk_signals['NA'] +=1
+        metric_risk_badge("Market Froth Risk (Low BTC.D)", 'dominance', latest_dominance)
         
-        dom_chart_df = fetch_from_db_dash("SELECT * FROM bitcoin_dominance ORDER BY timestamp DESC LIMIT 365")
+        dom_chart_df = fetch_from_db_dash("SELECT * FROM (SELECT timestamp, dominance FROM bitcoin_dominance ORDER BY timestamp DESC LIMIT 365) ORDER BY timestamp")
         if len(dom_chart_df) > 1 and 'date' in dom_chart_df and 'dominance' in dom_chart_df: 
-            fig_dom = px.line(dom_chart_df.sort_values(by='date'), x='date', y='dominance', title='Bitcoin Dominance (Daily Snapshots - Last Year)')
+            fig_dom = build_line_chart('Bitcoin Dominance (Daily Snapshots - Last Year)', _col_bytes(dom_chart_df['date']),
+                                       (('BTC.D', _col_bytes(dom_chart_df['dominance']), None),))
             st.plotly_chart(fig_dom, use_container_width=True)
         else:
             st.caption("Displaying current dominance snapshot. Historical chart populates over time.")
     else:
-        st.write("Bitcoin Dominance data not available."); overall_risk_signals['NA'] +=1
+        st.write("Bitcoin Dominance data not available.")
+
+with col6:
+    render_dominance()
 
 st.divider()
 col7, col8, col9 = st.columns(3) 
 
 # --- METRIC 7: Stock-to-Flow Model ---
-with col7:
+@st.fragment
+def render_s2f():
     st.subheader("⛏️ Stock-to-Flow Model (BTC)")
-    s2f_df = fetch_from_db_dash("SELECT * FROM s2f_data ORDER BY timestamp DESC LIMIT 1") 
-    if not s2f_df.empty:
-        latest_s2f = s2f_df.iloc[0]
-        btc_price_s2f = latest_s2f['btc_price'] if 'btc_price' in latest_s2f and pd.notna(latest_s2f['btc_price']) else None
-        s2f_model_price = latest_s2f['s2f_price_model'] if 's2f_price_model' in latest_s2f and pd.notna(latest_s2f['s2f_price_model']) else None
-        s2f_ratio_val = latest_s2f['s2f_ratio'] if 's2f_ratio' in latest_s2f and pd.notna(latest_s2f['s2f_ratio']) else None
+    latest_snapshot = fetch_latest(LATEST_SNAPSHOT_SQL)
+    if latest_snapshot.get('s2f_ts') is not None:
+        btc_price_s2f = latest_snapshot.get('s2f_btc_price')
+        s2f_model_price = latest_snapshot.get('s2f_price_model')
+        s2f_ratio_val = latest_snapshot.get('s2f_ratio')
         
         deviation = None
         if s2f_model_price and s2f_model_price > 0 and btc_price_s2f is not None:
             deviation = btc_price_s2f / s2f_model_price
         
-        risk_html = get_risk_color_html(deviation, th.S2F_PRICE_DEVIATION_HIGH, th.S2F_PRICE_DEVIATION_MEDIUM)
-        st.markdown(f"**Price / S2F Model Ratio:** {risk_html}", unsafe_allow_html=True)
-
-        if deviation is not None:
-            if deviation >= th.S2F_PRICE_DEVIATION_HIGH: overall_risk_signals['Red'] +=1
-            elif deviation >= th.S2F_PRICE_DEVIATION_MEDIUM: overall_risk_signals['Yellow'] +=1
-            else: overall_risk_signals['Green'] +=1
-        else: overall_risk_signals['NA'] +=1
+        metric_risk_badge("Price / S2F Model Ratio", 's2f', deviation, risk=latest_snapshot.get('s2f_risk'))
         
         s2f_ratio_display = f"{s2f_ratio_val:.2f}" if s2f_ratio_val is not None else "N/A"
         s2f_model_price_display = f"${s2f_model_price:,.0f}" if s2f_model_price is not None else "N/A"
         st.caption(f"S2F Ratio: {s2f_ratio_display} | Model Price: {s2f_model_price_display}")
 
-        s2f_chart_df = fetch_from_db_dash("SELECT * FROM s2f_data ORDER BY timestamp DESC LIMIT 365*4") 
+        s2f_chart_df = fetch_history('s2f_data', ('btc_price', 's2f_price_model'), days=365*4)
         if not s2f_chart_df.empty and 'date' in s2f_chart_df and 'btc_price' in s2f_chart_df and 's2f_price_model' in s2f_chart_df:
-            fig_s2f = go.Figure()
-            fig_s2f.add_trace(go.Scatter(x=s2f_chart_df['date'].sort_values(), y=s2f_chart_df['btc_price'], mode='lines', name='BTC Price'))
-            fig_s2f.add_trace(go.Scatter(x=s2f_chart_df['date'].sort_values(), y=s2f_chart_df['s2f_price_model'], mode='lines', name='S2F Model Price', line=dict(dash='dash')))
-            fig_s2f.update_layout(title='Bitcoin Price vs. Stock-to-Flow Model', yaxis_type="log")
+            fig_s2f = build_line_chart('Bitcoin Price vs. Stock-to-Flow Model', _col_bytes(s2f_chart_df['date']),
+                                       (('BTC Price', _col_bytes(s2f_chart_df['btc_price']), None),
+                                        ('S2F Model Price', _col_bytes(s2f_chart_df['s2f_price_model']), 'dash')),
+                                       yaxis_type="log")
             st.plotly_chart(fig_s2f, use_container_width=True)
     else:
-        st.write("Stock-to-Flow data not available."); overall_risk_signals['NA'] +=1
+        st.write("Stock-to-Flow data not available.")
+
+with col7:
+    render_s2f()
 
 # --- METRIC 8: Puell Multiple (Calculated) ---
-with col8:
+@st.fragment
+def render_puell():
     st.subheader("🏭 Puell Multiple (Calculated)")
-    puell_df = fetch_from_db_dash("SELECT * FROM puell_multiple_calculated ORDER BY timestamp DESC LIMIT 1")
-    if not puell_df.empty:
-        latest_puell_val = puell_df.iloc[0]['puell_multiple'] if 'puell_multiple' in puell_df.columns and pd.notna(puell_df.iloc[0]['puell_multiple']) else None
-        risk_html = get_risk_color_html(latest_puell_val, th.PUELL_HIGH_RISK, th.PUELL_MEDIUM_RISK)
-        st.markdown(f"**Current Puell Multiple:** {risk_html}", unsafe_allow_html=True)
-
-        if latest_puell_val is not None:
-            if latest_puell_val >= th.PUELL_HIGH_RISK: overall_risk_signals['Red'] +=1
-            elif latest_puell_val >= th.PUELL_MEDIUM_RISK: overall_risk_signals['Yellow'] +=1
-            else: overall_risk_signals['Green'] +=1
-        else: overall_risk_signals['NA'] +=1
+    latest_snapshot = fetch_latest(LATEST_SNAPSHOT_SQL)
+    if latest_snapshot.get('puell_ts') is not None:
+        latest_puell_val = latest_snapshot.get('puell_multiple')
+        metric_risk_badge("Current Puell Multiple", 'puell', latest_puell_val, risk=latest_snapshot.get('puell_risk'))
         
-        puell_chart_df = fetch_from_db_dash("SELECT * FROM puell_multiple_calculated ORDER BY timestamp DESC LIMIT 365*2")
+        puell_chart_df = fetch_history('puell_multiple_calculated', ('puell_multiple',), days=365*2)
         if not puell_chart_df.empty and 'date' in puell_chart_df and 'puell_multiple' in puell_chart_df:
-            fig_puell = px.line(puell_chart_df.sort_values(by='date'), x='date', y='puell_multiple', title='Puell Multiple (Calculated)')
-            fig_puell.add_hline(y=th.PUELL_HIGH_RISK, line_dash="dash", line_color="red", annotation_text="High Risk Zone")
-            fig_puell.add_hline(y=th.PUELL_MEDIUM_RISK, line_dash="dash", line_color="orange", annotation_text="Medium Risk Zone")
+            fig_puell = build_line_chart('Puell Multiple (Calculated)', _col_bytes(puell_chart_df['date']),
+                                         (('Puell Multiple', _col_bytes(puell_chart_df['puell_multiple']), None),),
+                                         hlines=((th.PUELL_HIGH_RISK, "red", "High Risk Zone"), (th.PUELL_MEDIUM_RISK, "orange", "Medium Risk Zone")))
             st.plotly_chart(fig_puell, use_container_width=True)
         else:
              st.write("Chart data for Puell Multiple not available (may need a few more days of price data).")
     else:
-        st.write("Puell Multiple data not available (may need a few more days of price data)."); overall_risk_signals['NA'] +=1
+        st.write("Puell Multiple data not available (may need a few more days of price data).")
+
+with col8:
+    render_puell()
 
 # --- METRIC 9: Macro Indicators ---
-with col9: 
+@st.fragment
+def render_macro():
     st.subheader("🌍 Macro Indicators (Latest)")
-    macro_tickers_to_display = ['SPX', 'Gold', 'DXY', 'US10Y']
-    for ticker_name in macro_tickers_to_display:
-        df_macro = fetch_from_db_dash(f"SELECT * FROM macro_indicators WHERE ticker = '{ticker_name}' ORDER BY date DESC LIMIT 1") 
-        if not df_macro.empty:
-            latest_val = df_macro.iloc[0]['close_price'] if 'close_price' in df_macro.columns and pd.notna(df_macro.iloc[0]['close_price']) else None
+    macro_latest_df = fetch_from_db_dash(MACRO_LATEST_SQL, MACRO_TICKERS)
+    macro_latest = macro_latest_df.set_index('ticker')['close_price'].to_dict() if 'ticker' in macro_latest_df.columns else {}
+    for ticker_name in MACRO_TICKERS:
+        if ticker_name in macro_latest:
+            latest_val = macro_latest[ticker_name] if pd.notna(macro_latest[ticker_name]) else None
             st.metric(label=f"{ticker_name} Latest Close", value=f"{latest_val:,.2f}" if latest_val is not None else "N/A")
         else:
-            st.write(f"{ticker_name} data not available."); overall_risk_signals['NA'] +=1
+            st.write(f"{ticker_name} data not available.")
     st.caption("Individual charts for macro indicators can be added by fetching more history for display.")
 
+with col9:
+    render_macro()
 
 st.divider()
 # --- OVERALL RISK ASSESSMENT ---
-st.header("🚦 Overall Market Risk Assessment")
-countable_indicators = overall_risk_signals['Green'] + overall_risk_signals['Yellow'] + overall_risk_signals['Red']
-if countable_indicators > 0:
-    st.markdown(
-        f"**Active Signals Breakdown:** <span style='color:red;'>{overall_risk_signals['Red']} High</span> | "
-        f"<span style='color:orange;'>{overall_risk_signals['Yellow']} Medium</span> | "
-        f"<span style='color:green;'>{overall_risk_signals['Green']} Low</span> "
-        f"(out of {countable_indicators} indicators with conclusive signals). "
-        f"{overall_risk_signals['NA']} indicators have N/A data.",
-        unsafe_allow_html=True)
-
-    overall_color = "green"; overall_text = "Low Overall Market Risk"; details = [] 
-    if overall_risk_signals['Red'] >= th.OVERALL_HIGH_RISK_COUNT_RED:
-        overall_color = "red"; overall_text = "High Overall Market Risk - Extreme Caution Advised!"
-        details.append(f"Reason: {overall_risk_signals['Red']} indicators signaling High Risk (Threshold: >={th.OVERALL_HIGH_RISK_COUNT_RED}).")
+@st.fragment
+def render_overall_risk():
+    st.header("🚦 Overall Market Risk Assessment")
+    st.session_state['risk_counts'] = overall_risk_counts()
+    overall_risk_signals = st.session_state['risk_counts']
+    countable_indicators = overall_risk_signals['Green'] + overall_risk_signals['Yellow'] + overall_risk_signals['Red']
+    if countable_indicators > 0:
+        st.markdown(
+            f"**Active Signals Breakdown:** :red[{overall_risk_signals['Red']} High] | "
+            f":orange[{overall_risk_signals['Yellow']} Medium] | "
+            f":green[{overall_risk_signals['Green']} Low] "
+            f"(out of {countable_indicators} indicators with conclusive signals). "
+            f"{overall_risk_signals['NA']} indicators have N/A data.")
+
+        overall_color = "green"; overall_text = "Low Overall Market Risk"; details = [] 
+        if overall_risk_signals['Red'] >= th.OVERALL_HIGH_RISK_COUNT_RED:
+            overall_color = "red"; overall_text = "High Overall Market Risk - Extreme Caution Advised!"
+            details.append(f"Reason: {overall_risk_signals['Red']} indicators signaling High Risk (Threshold: >={th.OVERALL_HIGH_RISK_COUNT_RED}).")
     
-    elif overall_color != "red": # This check is now implicitly handled by the elif structure
-        condition_medium_by_red_count = (overall_risk_signals['Red'] >= th.OVERALL_MEDIUM_RISK_COUNT_RED)
-        condition_medium_by_sum = ((overall_risk_signals['Red'] + overall_risk_signals['Yellow']) >= th.OVERALL_MEDIUM_RISK_SUM_YELLOW_RED)
-        if condition_medium_by_red_count or condition_medium_by_sum:
-            overall_color = "orange"; overall_text = "Elevated Overall Market Risk - Caution Advised."
-            # Provide reasons in order of precedence or combine if both contribute
-            if condition_medium_by_red_count:
-                 details.append(f"Reason: {overall_risk_signals['Red']} High Risk signals (Medium Overall threshold: >={th.OVERALL_MEDIUM_RISK_COUNT_RED}).")
-            if condition_medium_by_sum and not (condition_medium_by_red_count and th.OVERALL_MEDIUM_RISK_COUNT_RED == th.OVERALL_HIGH_RISK_COUNT_RED) : # Avoid redundant messaging if already red due to count
-                details.append(f"Reason: Sum of {overall_risk_signals['Red'] + overall_risk_signals['Yellow']} High/Medium signals (Sum threshold: >={th.OVERALL_MEDIUM_RISK_SUM_YELLOW_RED}).")
-        else: 
-            details.append("Reason: Number of High/Medium risk indicators below defined thresholds for elevated risk.")
-
-    st.markdown(f"### <span style='color:{overall_color};'>{overall_text}</span>", unsafe_allow_html=True)
-    if details:
-        for detail_item in details: st.caption(detail_item)
+        elif overall_color != "red": # This check is now implicitly handled by the elif structure
+            condition_medium_by_red_count = (overall_risk_signals['Red'] >= th.OVERALL_MEDIUM_RISK_COUNT_RED)
+            condition_medium_by_sum = ((overall_risk_signals['Red'] + overall_risk_signals['Yellow']) >= th.OVERALL_MEDIUM_RISK_SUM_YELLOW_RED)
+            if condition_medium_by_red_count or condition_medium_by_sum:
+                overall_color = "orange"; overall_text = "Elevated Overall Market Risk - Caution Advised."
+                # Provide reasons in order of precedence or combine if both contribute
+                if condition_medium_by_red_count:
+                     details.append(f"Reason: {overall_risk_signals['Red']} High Risk signals (Medium Overall threshold: >={th.OVERALL_MEDIUM_RISK_COUNT_RED}).")
+                if condition_medium_by_sum and not (condition_medium_by_red_count and th.OVERALL_MEDIUM_RISK_COUNT_RED == th.OVERALL_HIGH_RISK_COUNT_RED) : # Avoid redundant messaging if already red due to count
+                    details.append(f"Reason: Sum of {overall_risk_signals['Red'] + overall_risk_signals['Yellow']} High/Medium signals (Sum threshold: >={th.OVERALL_MEDIUM_RISK_SUM_YELLOW_RED}).")
+            else: 
+                details.append("Reason: Number of High/Medium risk indicators below defined thresholds for elevated risk.")
+
+        st.markdown(f"### :{overall_color}[{overall_text}]")
+        if details:
+            for detail_item in details: st.caption(detail_item)
     
-    current_risk_points = (overall_risk_signals['Red'] * 2) + (overall_risk_signals['Yellow'] * 1)
-    max_possible_points_from_active = countable_indicators * 2 
-    if max_possible_points_from_active > 0:
-        risk_percentage = (current_risk_points / max_possible_points_from_active)
-        st.progress(risk_percentage) 
-else:
-    st.write("Not enough conclusive signals from indicators to assess overall market risk.")
\ No newline at end of file
+        current_risk_points = (overall_risk_signals['Red'] * 2) + (overall_risk_signals['Yellow'] * 1)
+        max_possible_points_from_active = countable_indicators * 2 
+        if max_possible_points_from_active > 0:
+            risk_percentage = (current_risk_points / max_possible_points_from_active)
+            st.progress(risk_percentage) 
+    else:
+        st.write("Not enough conclusive signals from indicators to assess overall market risk.")
+
+render_overall_risk()
@@ -1,236 +1,388 @@
 # data_fetcher.py
 import sqlite3
 import pandas as pd
+import numpy as np
 from pycoingecko import CoinGeckoAPI
 from pytrends.request import TrendReq
 import yfinance as yf
 import requests
-from datetime import datetime, timedelta, timezone
+import cachetools
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+from datetime import date, datetime, timedelta, timezone
 import time # For rate limiting
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # --- CONFIGURATIONS ---
 DB_PATH = 'data/crypto_metrics.db'
 cg = CoinGeckoAPI() 
 
+class _HostThrottle:
+    """Spaces calls to one API host at least min_interval seconds apart, across threads."""
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.min_interval
+        time.sleep(slot - now)
+
+COINGECKO_THROTTLE = _HostThrottle(2.0) # Free tier allows 30 requests/minute
+YAHOO_THROTTLE = _HostThrottle(1.5)
+
+def _is_transient_api_error(exc):
+    """Network/HTTP errors, plus CoinGecko's JSON 429 replies (pycoingecko raises those as ValueError)."""
+    return isinstance(exc, requests.exceptions.RequestException) or (isinstance(exc, ValueError) and '429' in str(exc))
+
+@retry(wait=wait_exponential_jitter(initial=1, max=10), stop=stop_after_attempt(5),
+       retry=retry_if_exception(_is_transient_api_error), reraise=True)
+def _coingecko(api_method, *args, **kwargs):
+    """Calls a CoinGecko client method inside the host throttle, backing off and retrying transient failures."""
+    COINGECKO_THROTTLE.wait()
+    return api_method(*args, **kwargs)
+
 # --- DATABASE UTILITIES ---
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+def _open_conn():
+    """Writer connection tuned for batched inserts. WAL is persistent in the file and lets the
+    dashboard's read-only connection read while updates write; NORMAL only fsyncs at checkpoints."""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-65536') # 64 MB page cache
+    return conn
+
+def open_arrow_reader(db_path=DB_PATH):
+    """Read-only ADBC connection (adbc_driver_sqlite) for Arrow-backed reads. autocommit=True gives each
+    query its own read transaction; ADBC's default would BEGIN once and pin that snapshot (and the WAL) forever."""
+    import adbc_driver_sqlite.dbapi as sqlite_adbc # Optional dependency, only needed by columnar readers
+    return sqlite_adbc.connect(f"file:{db_path}?mode=ro", autocommit=True)
+
+# Serializes use of the shared writer: two dashboard sessions refreshing at once run on different
+# threads, and without it one session's commit/rollback would end the other's transaction.
+_DB_LOCK = threading.RLock()
+
+@functools.lru_cache(maxsize=1)
+def _get_conn():
+    """Module-wide writer connection, opened on first use and reused by every helper (under _DB_LOCK)."""
+    return _open_conn()
+
+# Full schema, run as one script by init_db. Every statement is IF NOT EXISTS, so it is safe on each start.
+SCHEMA_SQL = """
+BEGIN;
+
+-- Bitcoin & Ethereum Prices
+CREATE TABLE IF NOT EXISTS crypto_prices (
+    timestamp INTEGER NOT NULL,
+    coin_id TEXT NOT NULL,
+    price REAL,
+    market_cap REAL,
+    total_volume REAL,
+    PRIMARY KEY (timestamp, coin_id)
+);
+
+-- Fear & Greed Index
+CREATE TABLE IF NOT EXISTS fear_greed_index (
+    timestamp INTEGER PRIMARY KEY,
+    value INTEGER,
+    value_classification TEXT
+);
+
+-- Google Trends
+CREATE TABLE IF NOT EXISTS google_trends (
+    date TEXT PRIMARY KEY,
+    bitcoin_trends INTEGER
+);
+
+-- Macro Indicators (SPX, Gold, DXY, US10Y)
+CREATE TABLE IF NOT EXISTS macro_indicators (
+    date TEXT NOT NULL,
+    ticker TEXT NOT NULL,
+    close_price REAL,
+    PRIMARY KEY (date, ticker)
+);
+
+-- Bitcoin Dominance (stores daily snapshot of current dominance)
+CREATE TABLE IF NOT EXISTS bitcoin_dominance (
+    timestamp INTEGER PRIMARY KEY,
+    dominance REAL
+);
+
+-- Calculated Pi Cycle Data
+CREATE TABLE IF NOT EXISTS pi_cycle_data (
+    timestamp INTEGER PRIMARY KEY,
+    btc_price REAL,
+    sma_111 REAL,
+    sma_350_doubled REAL,
+    signal TEXT,
+    risk_code INTEGER -- -1 N/A, 0 green, 1 yellow, 2 red (formulas.risk_codes)
+);
+
+-- Calculated 200WMA Data
+CREATE TABLE IF NOT EXISTS wma_200_data (
+    timestamp INTEGER PRIMARY KEY, 
+    btc_price REAL,
+    wma_200 REAL,
+    risk_code INTEGER
+);
+
+-- Stock-to-Flow Data
+CREATE TABLE IF NOT EXISTS s2f_data (
+    timestamp INTEGER PRIMARY KEY,
+    btc_price REAL,
+    s2f_ratio REAL,
+    s2f_price_model REAL,
+    risk_code INTEGER
+);
+
+-- Calculated Puell Multiple Data
+CREATE TABLE IF NOT EXISTS puell_multiple_calculated (
+    timestamp INTEGER PRIMARY KEY,
+    btc_price REAL,
+    daily_issuance_usd REAL,
+    daily_issuance_usd_365d_ma REAL,
+    puell_multiple REAL,
+    risk_code INTEGER
+);
+
+-- Bitcoin Circulating Supply Info
+CREATE TABLE IF NOT EXISTS bitcoin_supply_info (
+    timestamp INTEGER PRIMARY KEY,
+    circulating_supply REAL
+);
+
+-- Per-coin / per-ticker "latest N rows" lookups. The primary keys lead with
+-- timestamp/date, so without these SQLite scans and sorts the whole table.
+-- Carrying price makes the price index covering: BTC history reads never touch the table.
+DROP INDEX IF EXISTS idx_crypto_prices_coin_ts;
+CREATE INDEX IF NOT EXISTS idx_crypto_prices_coin_ts_price ON crypto_prices(coin_id, timestamp DESC, price);
+CREATE INDEX IF NOT EXISTS idx_macro_ticker_date ON macro_indicators(ticker, date DESC);
+
+-- Latest value of each risk indicator, one (metric, value, risk_code) row apiece; NULL when the
+-- source table is empty. risk_code is the code the calculators stored with that row; the raw-source
+-- metrics have none, so theirs is NULL and the dashboard classifies their value. Recreated on each
+-- start so existing databases pick up column changes.
+DROP VIEW IF EXISTS latest_metrics;
+CREATE VIEW latest_metrics AS
+SELECT 'fear_greed' AS metric, (SELECT value FROM fear_greed_index ORDER BY timestamp DESC LIMIT 1) AS value, NULL AS risk_code
+UNION ALL SELECT 'google_trends', (SELECT bitcoin_trends FROM google_trends ORDER BY date DESC LIMIT 1), NULL
+UNION ALL SELECT 'dominance', (SELECT dominance FROM bitcoin_dominance ORDER BY timestamp DESC LIMIT 1), NULL
+UNION ALL SELECT 'pi_cycle', pi.value, pi.risk_code FROM (SELECT 1)
+    LEFT JOIN (SELECT sma_111 / NULLIF(sma_350_doubled, 0) AS value, risk_code FROM pi_cycle_data ORDER BY timestamp DESC LIMIT 1) AS pi
+UNION ALL SELECT 'wma_200', wma.value, wma.risk_code FROM (SELECT 1)
+    LEFT JOIN (SELECT btc_price / NULLIF(wma_200, 0) AS value, risk_code FROM wma_200_data ORDER BY timestamp DESC LIMIT 1) AS wma
+UNION ALL SELECT 's2f', s2f.value, s2f.risk_code FROM (SELECT 1)
+    LEFT JOIN (SELECT btc_price / NULLIF(s2f_price_model, 0) AS value, risk_code FROM s2f_data ORDER BY timestamp DESC LIMIT 1) AS s2f
+UNION ALL SELECT 'puell', puell.value, puell.risk_code FROM (SELECT 1)
+    LEFT JOIN (SELECT puell_multiple AS value, risk_code FROM puell_multiple_calculated ORDER BY timestamp DESC LIMIT 1) AS puell;
+
+COMMIT;
+"""
+
+# Columns added to existing tables after release. ALTER TABLE has no IF NOT EXISTS, so init_db
+# checks table_info first; rows written before the migration keep NULL there.
+ADDED_COLUMNS = [
+    ('pi_cycle_data', 'risk_code', 'INTEGER'),
+    ('wma_200_data', 'risk_code', 'INTEGER'),
+    ('s2f_data', 'risk_code', 'INTEGER'),
+    ('puell_multiple_calculated', 'risk_code', 'INTEGER'),
+]
+
+# Calculated tables written with INSERT OR REPLACE keyed on timestamp. Copies created by the old
+# to_sql('replace') have no primary key, so init_db gives those a unique index to dedupe on.
+CALCULATED_TABLES = ('pi_cycle_data', 'wma_200_data', 's2f_data', 'puell_multiple_calculated')
 
-    # Bitcoin & Ethereum Prices
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS crypto_prices (
-        timestamp INTEGER NOT NULL,
-        coin_id TEXT NOT NULL,
-        price REAL,
-        market_cap REAL,
-        total_volume REAL,
-        PRIMARY KEY (timestamp, coin_id)
-    )
-    ''')
-
-    # Fear & Greed Index
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS fear_greed_index (
-        timestamp INTEGER PRIMARY KEY,
-        value INTEGER,
-        value_classification TEXT
-    )
-    ''')
-
-    # Google Trends
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS google_trends (
-        date TEXT PRIMARY KEY,
-        bitcoin_trends INTEGER
-    )
-    ''') 
-
-    # Macro Indicators (SPX, Gold, DXY, US10Y)
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS macro_indicators (
-        date TEXT NOT NULL,
-        ticker TEXT NOT NULL,
-        close_price REAL,
-        PRIMARY KEY (date, ticker)
-    )
-    ''') 
-
-    # Bitcoin Dominance (stores daily snapshot of current dominance)
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS bitcoin_dominance (
-        timestamp INTEGER PRIMARY KEY,
-        dominance REAL
-    )
-    ''')
-    
-    # Calculated Pi Cycle Data
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS pi_cycle_data (
-        timestamp INTEGER PRIMARY KEY,
-        btc_price REAL,
-        sma_111 REAL,
-        sma_350_doubled REAL,
-        signal TEXT 
-    )
-    ''')
-
-    # Calculated 200WMA Data
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS wma_200_data (
-        timestamp INTEGER PRIMARY KEY, 
-        btc_price REAL,
-        wma_200 REAL
-    )
-    ''')
-    
-    # Stock-to-Flow Data
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS s2f_data (
-        timestamp INTEGER PRIMARY KEY,
-        btc_price REAL,
-        s2f_ratio REAL,
-        s2f_price_model REAL
-    )
-    ''')
-
-    # Calculated Puell Multiple Data
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS puell_multiple_calculated (
-        timestamp INTEGER PRIMARY KEY,
-        btc_price REAL,
-        daily_issuance_usd REAL,
-        daily_issuance_usd_365d_ma REAL,
-        puell_multiple REAL
-    )
-    ''')
-
-    # Bitcoin Circulating Supply Info
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS bitcoin_supply_info (
-        timestamp INTEGER PRIMARY KEY,
-        circulating_supply REAL
-    )
-    ''')
-
-    conn.commit()
-    conn.close()
+def init_db():
+    with _DB_LOCK:
+        conn = _get_conn()
+        try:
+            conn.executescript(SCHEMA_SQL)
+        except sqlite3.Error:
+            if conn.in_transaction: # Don't leave the script's BEGIN open on the shared connection
+                conn.rollback()
+            raise
+        for table, column, column_type in ADDED_COLUMNS:
+            existing_columns = {row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')}
+            if column not in existing_columns:
+                conn.execute(f'ALTER TABLE "{table}" ADD COLUMN "{column}" {column_type}')
+        for table in CALCULATED_TABLES:
+            timestamp_is_pk = any(row[1] == 'timestamp' and row[5] for row in conn.execute(f'PRAGMA table_info("{table}")'))
+            if timestamp_is_pk: # The PK b-tree already dedupes; a second index only doubles the writes
+                conn.execute(f'DROP INDEX IF EXISTS "idx_{table}_timestamp"')
+            else:
+                conn.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS "idx_{table}_timestamp" ON "{table}"(timestamp)')
 
 def get_last_timestamp(table_name, coin_id=None):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _get_conn()
     cursor = conn.cursor()
-    query = f"SELECT MAX(timestamp) FROM \"{table_name}\"" # Quote table name
+    # Newest-first LIMIT 1 is a single seek on the PK or idx_crypto_prices_coin_ts_price
+    query = f"SELECT timestamp FROM \"{table_name}\"" # Quote table name
+    params = ()
     if coin_id:
-        query += f" WHERE coin_id = '{coin_id}'"
+        query += " WHERE coin_id = ?" # Bound, so one cached statement serves every coin
+        params = (coin_id,)
+    query += " ORDER BY timestamp DESC LIMIT 1"
     try:
-        cursor.execute(query)
-        result = cursor.fetchone()[0]
+        with _DB_LOCK:
+            cursor.execute(query, params)
+            row = cursor.fetchone()
+        result = row[0] if row else None
     except sqlite3.Error:
         result = None
     finally:
-        conn.close()
+        cursor.close()
     return result if result else 0 
 
 def get_last_date_str(table_name, ticker_column=None, ticker_value=None):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _get_conn()
     cursor = conn.cursor()
-    query = f"SELECT MAX(date) FROM \"{table_name}\"" # Quote table name
+    query = f"SELECT date FROM \"{table_name}\"" # Quote table name
+    params = ()
     if ticker_column and ticker_value:
-        query += f" WHERE \"{ticker_column}\" = '{ticker_value}'"
+        query += f" WHERE \"{ticker_column}\" = ?"
+        params = (ticker_value,)
+    query += " ORDER BY date DESC LIMIT 1"
 
     try:
-        cursor.execute(query)
-        result = cursor.fetchone()[0]
+        with _DB_LOCK:
+            cursor.execute(query, params)
+            row = cursor.fetchone()
+        result = row[0] if row else None
     except sqlite3.Error:
         result = None
     finally:
-        conn.close()
+        cursor.close()
     return result 
 
-def store_data_incrementally(df_new_data, table_name, pk_columns_list):
+def store_data_incrementally(df_new_data, table_name, pk_columns_list, min_pk=None, strategy='upsert'):
+    """Inserts rows whose primary key is not stored yet. min_pk (the caller's already-known last
+    timestamp/date) drops rows at or below it before anything is sent to SQLite.
+
+    strategy='upsert' targets the PK with ON CONFLICT(pk) DO NOTHING; strategy='ignore' emits a
+    plain INSERT OR IGNORE for append-only tables keyed by a single monotonic timestamp.
+    """
     if df_new_data.empty:
         # print(f"No new data provided to store in {table_name}.") # Less verbose
         return
 
     df_new_data.columns = [str(col) for col in df_new_data.columns]
     pk_columns_list = [str(col) for col in pk_columns_list]
+    if min_pk is not None:
+        df_new_data = df_new_data[df_new_data[pk_columns_list[0]] > min_pk]
+        if df_new_data.empty:
+            print(f"No rows newer than the last stored key in {table_name}.")
+            return
+
+    # Rows whose primary key already exists are skipped by SQLite itself via the PK index,
+    # so there is no need to read existing keys back and anti-join them in pandas.
+    columns_sql = ", ".join(f'"{col}"' for col in df_new_data.columns)
+    placeholders = ", ".join("?" * len(df_new_data.columns))
+    if strategy == 'ignore':
+        insert_sql = f'INSERT OR IGNORE INTO "{table_name}" ({columns_sql}) VALUES ({placeholders})'
+    else:
+        pk_sql = ", ".join(f'"{col}"' for col in pk_columns_list)
+        insert_sql = f'INSERT INTO "{table_name}" ({columns_sql}) VALUES ({placeholders}) ON CONFLICT({pk_sql}) DO NOTHING'
 
-    conn = sqlite3.connect(DB_PATH)
+    conn = _get_conn()
     try:
-        temp_composite_pk_col = '_temp_composite_pk_for_merge'
-        
-        if len(pk_columns_list) > 1:
-            # Create composite keys for matching for new data
-            df_new_data[temp_composite_pk_col] = df_new_data[pk_columns_list].astype(str).agg('_'.join, axis=1)
-            
-            # Query existing composite keys
-            existing_pks_db_str_list = []
-            for col in pk_columns_list:
-                # Attempt to cast to TEXT, especially for date/timestamp columns which might be stored differently
-                if 'date' in col.lower() or 'timestamp' in col.lower():
-                    existing_pks_db_str_list.append(f'CAST("{col}" AS TEXT)')
-                else:
-                    existing_pks_db_str_list.append(f'"{col}"')
-            existing_pks_db_str = " || '_' || ".join(existing_pks_db_str_list)
-            existing_pks_query = f'SELECT DISTINCT {existing_pks_db_str} AS "{temp_composite_pk_col}" FROM "{table_name}"' # Quote table_name
-            
-        else: # Single primary key
-            pk_col_name = pk_columns_list[0]
-            existing_pks_query = f'SELECT DISTINCT "{pk_col_name}" FROM "{table_name}"' # Quote table_name
-            
-        try:
-            df_existing_pks = pd.read_sql_query(existing_pks_query, conn)
-        except pd.io.sql.DatabaseError: # Table might not exist on first run for this specific query
-            df_existing_pks = pd.DataFrame()
-
-
-        if not df_existing_pks.empty:
-            if len(pk_columns_list) > 1:
-                # We are comparing based on the temporary composite key
-                df_to_insert = df_new_data[~df_new_data[temp_composite_pk_col].isin(df_existing_pks[temp_composite_pk_col])].copy()
-            else: # Single PK
-                pk_col_name = pk_columns_list[0]
-                # Ensure type consistency for comparison with single PK
-                if pd.api.types.is_datetime64_any_dtype(df_new_data[pk_col_name]) or 'date' in pk_col_name.lower():
-                    df_new_data_pk_as_str = pd.to_datetime(df_new_data[pk_col_name]).dt.strftime('%Y-%m-%d')
-                    existing_pks_as_str = pd.to_datetime(df_existing_pks[pk_col_name]).dt.strftime('%Y-%m-%d')
-                    df_to_insert = df_new_data[~df_new_data_pk_as_str.isin(existing_pks_as_str)].copy()
-                elif pd.api.types.is_numeric_dtype(df_new_data[pk_col_name]):
-                    df_to_insert = df_new_data[~df_new_data[pk_col_name].astype(float).isin(df_existing_pks[pk_col_name].astype(float))].copy()
-                else: # Assume string
-                    df_to_insert = df_new_data[~df_new_data[pk_col_name].astype(str).isin(df_existing_pks[pk_col_name].astype(str))].copy()
-        else: # No existing data, so all new data is to be inserted
-            df_to_insert = df_new_data.copy()
-        
-        # Clean up temporary column if it was added
-        if temp_composite_pk_col in df_to_insert.columns:
-            df_to_insert.drop(columns=[temp_composite_pk_col], inplace=True)
-
-        if not df_to_insert.empty:
-            # Ensure only original columns are inserted
-            original_columns = [col for col in df_new_data.columns if col != temp_composite_pk_col]
-            df_to_insert[original_columns].to_sql(table_name, conn, if_exists='append', index=False)
-            print(f"{len(df_to_insert)} new rows stored in {table_name}.")
+        with _DB_LOCK, conn: # Single transaction; commits on success, rolls back on error
+            # astype(object) hands sqlite3 plain Python ints/floats instead of NumPy scalars
+            cursor = conn.executemany(insert_sql, df_new_data.astype(object).itertuples(index=False, name=None))
+        if cursor.rowcount > 0:
+            print(f"{cursor.rowcount} new rows stored in {table_name}.")
         else:
             print(f"No new unique rows to store in {table_name} (all provided rows already exist or df was empty).")
 
     except Exception as e:
         print(f"Error in store_data_incrementally for {table_name}: {e}. New DF Dtypes:\n{df_new_data.dtypes if not df_new_data.empty else 'New DF Empty'}")
-    finally:
-        conn.close()
+
+def _insert_row(table_name, columns, values):
+    """Single-row INSERT OR IGNORE for daily snapshots; no DataFrame needed."""
+    columns_sql = ", ".join(f'"{col}"' for col in columns)
+    placeholders = ", ".join("?" * len(columns))
+    conn = _get_conn()
+    try:
+        with _DB_LOCK, conn:
+            cursor = conn.execute(f'INSERT OR IGNORE INTO "{table_name}" ({columns_sql}) VALUES ({placeholders})', values)
+        if cursor.rowcount > 0:
+            print(f"1 new row stored in {table_name}.")
+        else:
+            print(f"Row already stored in {table_name}.")
+    except sqlite3.Error as e:
+        print(f"Error in _insert_row for {table_name}: {e}")
 
 # --- DATA FETCHING FUNCTIONS ---
+def _fetch_market_snapshots(coin_ids, vs_currency):
+    """Latest price/market cap/volume for all coins in one /coins/markets request."""
+    try:
+        markets = _coingecko(cg.get_coins_markets, vs_currency=vs_currency, ids=','.join(coin_ids))
+        if not markets:
+            return None
+        df = pd.DataFrame(markets)
+        now_ts = pd.Timestamp.now(tz='UTC').floor('s')
+        last_updated = pd.to_datetime(df['last_updated'], utc=True, format='ISO8601', errors='coerce').fillna(now_ts)
+        df['timestamp'] = last_updated.astype('int64') // 10**9
+        df.rename(columns={'id': 'coin_id', 'current_price': 'price'}, inplace=True)
+        return df[['timestamp', 'price', 'market_cap', 'total_volume', 'coin_id']]
+    except Exception as e:
+        print(f"Error fetching market snapshots for {coin_ids}: {e}")
+    return None
+
+def _aligned_chart_values(chart_data, key, timestamps_ms):
+    """Value column of a CoinGecko [timestamp_ms, value] series, lined up with the price timestamps.
+    The series normally arrive aligned, so the reindex is only a fallback; missing series give NaN."""
+    series = np.asarray(chart_data.get(key) or [], dtype=float).reshape(-1, 2)
+    if len(series) == 0:
+        return np.full(len(timestamps_ms), np.nan)
+    if len(series) == len(timestamps_ms) and np.array_equal(series[:, 0], timestamps_ms):
+        return series[:, 1]
+    return pd.Series(series[:, 1], index=series[:, 0]).groupby(level=0).last().reindex(timestamps_ms).to_numpy()
+
+def _fetch_coin_range(coin_id, vs_currency, from_timestamp_str, to_timestamp_str):
+    """HTTP + shaping for one coin's price range; runs on a worker thread, storage stays with the caller."""
+    try:
+        chart_data = _coingecko(
+            cg.get_coin_market_chart_range_by_id,
+            id=coin_id, 
+            vs_currency=vs_currency,
+            from_timestamp=from_timestamp_str,
+            to_timestamp=to_timestamp_str
+        )
+
+        if chart_data and 'prices' in chart_data and chart_data['prices']:
+            # One frame straight from the parallel arrays; no merges on timestamp
+            prices = np.asarray(chart_data['prices'], dtype=float)
+            prices_df = pd.DataFrame({
+                'timestamp': prices[:, 0].astype(np.int64) // 1000, # ms -> INTEGER seconds in one NumPy pass
+                'price': prices[:, 1],
+                'market_cap': _aligned_chart_values(chart_data, 'market_caps', prices[:, 0]),
+                'total_volume': _aligned_chart_values(chart_data, 'total_volumes', prices[:, 0]),
+            })
+            
+            prices_df['coin_id'] = coin_id
+            return prices_df[prices_df['timestamp'] >= int(from_timestamp_str)] 
+        # else: # Less verbose
+            # print(f"No new price data found for {coin_id} from {datetime.fromtimestamp(int(from_timestamp_str), timezone.utc)}.")
+
+    except Exception as e:
+        print(f"Error fetching price for {coin_id} in range: {e}")
+    return None
+
 def fetch_crypto_prices(coin_ids=['bitcoin', 'ethereum'], vs_currency='usd', initial_days_fetch=360):
     print(f"Fetching prices for {coin_ids}...")
     today_timestamp = int(datetime.now(timezone.utc).timestamp())
+    to_timestamp_str = str(today_timestamp)
 
+    ranges_to_fetch = [] 
+    snapshot_coins = [] # At most a day behind: the latest market snapshot is enough
     for coin_id in coin_ids:
-        all_coin_data_for_this_id = [] 
         last_stored_timestamp = get_last_timestamp('crypto_prices', coin_id=coin_id)
         
-        from_timestamp_str = ""
-        to_timestamp_str = str(today_timestamp)
-
         if last_stored_timestamp > 0:
             from_timestamp_dt = datetime.fromtimestamp(last_stored_timestamp, timezone.utc) + timedelta(seconds=1)
             from_timestamp_str = str(int(from_timestamp_dt.timestamp()))
@@ -239,49 +391,28 @@ def fetch_crypto_prices(coin_ids=['bitcoin', 'ethereum'], vs_currency='usd', ini
             if int(from_timestamp_str) >= today_timestamp:
                 print(f"Price data for {coin_id} appears up to date.")
                 continue 
+            if today_timestamp - last_stored_timestamp <= 86400:
+                snapshot_coins.append(coin_id)
+                continue
         else:
             from_timestamp_dt = datetime.now(timezone.utc) - timedelta(days=initial_days_fetch)
             from_timestamp_str = str(int(from_timestamp_dt.timestamp()))
             print(f"No existing price data for {coin_id}. Fetching last {initial_days_fetch} days from ~{from_timestamp_dt.date()}...")
-
-        try:
-            chart_data = cg.get_coin_market_chart_range_by_id(
-                id=coin_id, 
-                vs_currency=vs_currency,
-                from_timestamp=from_timestamp_str,
-                to_timestamp=to_timestamp_str
-            )
-            time.sleep(3) # Increased sleep for CoinGecko
-
-            if chart_data and 'prices' in chart_data and chart_data['prices']:
-                prices_df = pd.DataFrame(chart_data['prices'], columns=['timestamp', 'price'])
-                
-                if 'market_caps' in chart_data and chart_data['market_caps']:
-                     market_caps_df = pd.DataFrame(chart_data['market_caps'], columns=['timestamp', 'market_cap'])
-                     prices_df = pd.merge(prices_df, market_caps_df, on='timestamp', how='left')
-                else:
-                    prices_df['market_cap'] = None
-                
-                if 'total_volumes' in chart_data and chart_data['total_volumes']:
-                    total_volumes_df = pd.DataFrame(chart_data['total_volumes'], columns=['timestamp', 'total_volume'])
-                    prices_df = pd.merge(prices_df, total_volumes_df, on='timestamp', how='left')
-                else:
-                    prices_df['total_volume'] = None
-                
-                prices_df['timestamp'] = prices_df['timestamp'] // 1000 
-                prices_df['coin_id'] = coin_id
-                prices_df = prices_df[prices_df['timestamp'] >= int(from_timestamp_str)] 
-                all_coin_data_for_this_id.append(prices_df)
-            # else: # Less verbose
-                # print(f"No new price data found for {coin_id} from {datetime.fromtimestamp(int(from_timestamp_str), timezone.utc)}.")
-
-        except Exception as e:
-            print(f"Error fetching price for {coin_id} in range: {e}")
-
-        if all_coin_data_for_this_id:
-            final_df_coin = pd.concat(all_coin_data_for_this_id)
-            if not final_df_coin.empty:
-                store_data_incrementally(final_df_coin, 'crypto_prices', pk_columns_list=['timestamp', 'coin_id'])
+        ranges_to_fetch.append((coin_id, from_timestamp_str))
+
+    coin_frames = []
+    if snapshot_coins: # One request for every coin on the daily path
+        coin_frames.append(_fetch_market_snapshots(snapshot_coins, vs_currency))
+    if ranges_to_fetch: # Cold start or longer gaps: per-coin history ranges
+        # Requests overlap on worker threads (COINGECKO_THROTTLE keeps them rate-limited); writes stay on this thread
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            coin_frames.extend(executor.map(
+                lambda coin_range: _fetch_coin_range(coin_range[0], vs_currency, coin_range[1], to_timestamp_str),
+                ranges_to_fetch))
+
+    for final_df_coin in coin_frames:
+        if final_df_coin is not None and not final_df_coin.empty:
+            store_data_incrementally(final_df_coin, 'crypto_prices', pk_columns_list=['timestamp', 'coin_id'])
     # print(f"Crypto prices update attempt finished for {coin_ids}.") # Less verbose
 
 
@@ -301,11 +432,12 @@ def fetch_fear_greed_index(initial_limit=0, daily_limit=30):
         response.raise_for_status()
         data = response.json()['data']
         df = pd.DataFrame(data)
-        df['timestamp'] = pd.to_numeric(df['timestamp'])
+        df['timestamp'] = df['timestamp'].astype('int64') # API sends numeric strings; store INTEGER seconds
+        df['value'] = df['value'].astype('int64')
         df.rename(columns={'value_classification': 'value_classification'}, inplace=True) # Ensure column name consistency
         df = df[['timestamp', 'value', 'value_classification']] # Select and order columns
         
-        store_data_incrementally(df, 'fear_greed_index', pk_columns_list=['timestamp'])
+        store_data_incrementally(df, 'fear_greed_index', pk_columns_list=['timestamp'], min_pk=last_stored_timestamp or None, strategy='ignore')
     except Exception as e:
         print(f"Error fetching Fear & Greed Index: {e}")
 
@@ -317,15 +449,14 @@ def fetch_google_trends(keyword="Bitcoin", initial_timeframe='today 5-y'):
     current_timeframe = initial_timeframe
     fetch_df = True
     if last_date_str_db:
-        last_date_dt = datetime.strptime(last_date_str_db, '%Y-%m-%d').date()
+        last_date_dt = date.fromisoformat(last_date_str_db) # Stored as YYYY-MM-DD
+        end_date_fetch = datetime.now(timezone.utc).date()
         # Fetch a slightly wider window for recent daily trends, e.g., last 90 days, then filter
         # Pytrends daily data is more reliable over slightly longer recent periods than just a few days.
-        start_date_fetch_for_recent = datetime.now(timezone.utc).date() - timedelta(days=90) # Fetch last 90 days
+        start_date_fetch_for_recent = end_date_fetch - timedelta(days=90) # Fetch last 90 days
         if last_date_dt >= start_date_fetch_for_recent: # If our last data is within this recent window
              start_date_fetch_for_recent = last_date_dt + timedelta(days=1)
 
-        end_date_fetch = datetime.now(timezone.utc).date()
-
         if start_date_fetch_for_recent <= end_date_fetch:
             current_timeframe = f"{start_date_fetch_for_recent.strftime('%Y-%m-%d')} {end_date_fetch.strftime('%Y-%m-%d')}"
             # print(f"Last Google Trends data on {last_date_str_db}. Fetching new data for timeframe: {current_timeframe}...") # Less verbose
@@ -344,9 +475,9 @@ def fetch_google_trends(keyword="Bitcoin", initial_timeframe='today 5-y'):
                 df_filtered = df[[keyword]].copy() # Use .copy()
                 df_filtered.reset_index(inplace=True) 
                 df_filtered.rename(columns={'date': 'date', keyword: 'bitcoin_trends'}, inplace=True)
-                df_filtered['date'] = df_filtered['date'].dt.strftime('%Y-%m-%d')
+                df_filtered['date'] = df_filtered['date'].dt.strftime('%Y-%m-%d') # Text dates are always TEXT YYYY-MM-DD
                 
-                store_data_incrementally(df_filtered, 'google_trends', pk_columns_list=['date'])
+                store_data_incrementally(df_filtered, 'google_trends', pk_columns_list=['date'], min_pk=last_date_str_db)
             elif df.empty:
                  print(f"Google Trends returned empty dataframe for '{keyword}' for timeframe '{current_timeframe}'.")
             else: 
@@ -355,89 +486,97 @@ def fetch_google_trends(keyword="Bitcoin", initial_timeframe='today 5-y'):
             print(f"Error fetching Google Trends for timeframe '{current_timeframe}': {e}")
 
 
+def _fetch_macro_ticker(ticker_symbol, name, start_date_fetch_str):
+    """Downloads and shapes one ticker's closes on a worker thread. Uses Ticker.history, since
+    yf.download resets module-global state and is not safe to run concurrently."""
+    try:
+        YAHOO_THROTTLE.wait()
+        if start_date_fetch_str: # Incremental fetch
+            data = yf.Ticker(ticker_symbol).history(start=start_date_fetch_str, interval="1d", auto_adjust=True)
+        else: # Initial full history fetch
+            data = yf.Ticker(ticker_symbol).history(period="max", interval="1d", auto_adjust=True)
+
+        if not data.empty:
+            df = data[['Close']].copy() 
+            df.reset_index(inplace=True)
+            
+            # yfinance 'Date' column might be named 'index' or 'Date' or 'Datetime' after reset_index depending on version/data
+            date_col_name = 'Date' # Default
+            if 'index' in df.columns and pd.api.types.is_datetime64_any_dtype(df['index']):
+                date_col_name = 'index'
+            elif 'Datetime' in df.columns and pd.api.types.is_datetime64_any_dtype(df['Datetime']):
+                date_col_name = 'Datetime'
+            elif 'date' in df.columns and pd.api.types.is_datetime64_any_dtype(df['date']): # if already lowercase
+                date_col_name = 'date'
+
+            df.rename(columns={date_col_name: 'date', 'Close': 'close_price'}, inplace=True)
+            df['ticker'] = name
+            df['date'] = df['date'].dt.strftime('%Y-%m-%d') # Already datetime64 (the history index), no re-parse needed
+            
+            df = df[['date', 'ticker', 'close_price']] 
+            df.columns = ['date', 'ticker', 'close_price']
+
+            if not df.empty: 
+                return df
+    except Exception as e:
+        print(f"Error fetching {name} ({ticker_symbol}): {e}")
+    return None
+
 def fetch_macro_indicators(tickers={'^GSPC': 'SPX', 'GC=F': 'Gold', 'DX-Y.NYB': 'DXY', '^TNX': 'US10Y'}):
     print("Fetching Macro Indicators...")
-    all_new_macro_data = []
+    tickers_to_fetch = []
+    today = datetime.now(timezone.utc).date()
     
     for ticker_symbol, name in tickers.items():
         last_date_str_db = get_last_date_str('macro_indicators', ticker_column='ticker', ticker_value=name)
         
         start_date_fetch_str = None
-        fetch_this_ticker = True
 
         if last_date_str_db:
-            start_date_fetch = datetime.strptime(last_date_str_db, '%Y-%m-%d').date() + timedelta(days=1)
-            if start_date_fetch > datetime.now(timezone.utc).date():
+            start_date_fetch = date.fromisoformat(last_date_str_db) + timedelta(days=1)
+            if start_date_fetch > today:
                 # print(f"Macro data for {name} is up to date (last: {last_date_str_db}).") # Less verbose
-                fetch_this_ticker = False
-            else:
-                start_date_fetch_str = start_date_fetch.strftime('%Y-%m-%d')
-                # print(f"Last macro data for {name} on {last_date_str_db}. Fetching new data from {start_date_fetch_str}...") # Less verbose
+                continue
+            start_date_fetch_str = start_date_fetch.strftime('%Y-%m-%d')
+            # print(f"Last macro data for {name} on {last_date_str_db}. Fetching new data from {start_date_fetch_str}...") # Less verbose
         else:
             print(f"No existing macro data for {name}. Fetching max history...")
-        
-        if fetch_this_ticker:
-            try:
-                if start_date_fetch_str: # Incremental fetch
-                    data = yf.download(ticker_symbol, start=start_date_fetch_str, interval="1d", progress=False, auto_adjust=True)
-                else: # Initial full history fetch
-                    data = yf.download(ticker_symbol, period="max", interval="1d", progress=False, auto_adjust=True)
-                time.sleep(1.5) 
-
-                if not data.empty:
-                    df = data[['Close']].copy() 
-                    df.reset_index(inplace=True)
-                    
-                    # yfinance 'Date' column might be named 'index' or 'Date' or 'Datetime' after reset_index depending on version/data
-                    date_col_name = 'Date' # Default
-                    if 'index' in df.columns and pd.api.types.is_datetime64_any_dtype(df['index']):
-                        date_col_name = 'index'
-                    elif 'Datetime' in df.columns and pd.api.types.is_datetime64_any_dtype(df['Datetime']):
-                        date_col_name = 'Datetime'
-                    elif 'date' in df.columns and pd.api.types.is_datetime64_any_dtype(df['date']): # if already lowercase
-                        date_col_name = 'date'
-
-                    df.rename(columns={date_col_name: 'date', 'Close': 'close_price'}, inplace=True)
-                    df['ticker'] = name
-                    df['date'] = pd.to_datetime(df['date']).dt.strftime('%Y-%m-%d')
-                    
-                    df = df[['date', 'ticker', 'close_price']] 
-                    df.columns = ['date', 'ticker', 'close_price']
-
-                    if not df.empty: 
-                        all_new_macro_data.append(df)
-            except Exception as e:
-                print(f"Error fetching {name} ({ticker_symbol}): {e}")
+        tickers_to_fetch.append((ticker_symbol, name, start_date_fetch_str))
+
+    # Downloads overlap on worker threads (YAHOO_THROTTLE keeps them rate-limited); the write stays on this thread
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        all_new_macro_data = [df for df in executor.map(lambda args: _fetch_macro_ticker(*args), tickers_to_fetch) if df is not None]
 
     if all_new_macro_data:
-        final_df = pd.concat(all_new_macro_data).drop_duplicates()
-        if not final_df.empty:
-            final_df = final_df[['date', 'ticker', 'close_price']]
-            final_df.columns = ['date', 'ticker', 'close_price']
-            # print(f"Storing {len(final_df)} total new macro data points...") # Less verbose
-            store_data_incrementally(final_df, 'macro_indicators', pk_columns_list=['date', 'ticker'])
+        # Frames already have the table's columns; duplicate (date, ticker) keys are skipped by the ON CONFLICT insert
+        final_df = all_new_macro_data[0] if len(all_new_macro_data) == 1 else pd.concat(all_new_macro_data, ignore_index=True)
+        # print(f"Storing {len(final_df)} total new macro data points...") # Less verbose
+        store_data_incrementally(final_df, 'macro_indicators', pk_columns_list=['date', 'ticker'])
     # else: # Less verbose
         # print("No new macro indicators fetched overall.")
 
+# Supply and dominance both read Bitcoin's market row; one response serves both per run
+_btc_market_cache = cachetools.TTLCache(maxsize=1, ttl=300)
+
+@cachetools.cached(_btc_market_cache)
+def _get_btc_market_data():
+    """Bitcoin's /coins/markets row (flat: circulating_supply, market_cap, ...). Much smaller than
+    the /coins/bitcoin document. Unexpected responses raise, so they are not cached."""
+    markets = _coingecko(cg.get_coins_markets, vs_currency='usd', ids='bitcoin')
+    if not (isinstance(markets, list) and markets and isinstance(markets[0], dict)):
+        raise ValueError(f"Unexpected /coins/markets response: {str(markets)[:500]}")
+    return markets[0]
+
 def fetch_bitcoin_circulating_supply():
     print("Fetching Bitcoin circulating supply...")
     try:
-        coin_data = cg.get_coin_by_id(id='bitcoin', market_data='true', community_data='false', 
-                                      developer_data='false', localization='false')
-        time.sleep(3) # Increased sleep for CoinGecko
-        
-        circulating_supply = None
-        if coin_data and isinstance(coin_data, dict) and \
-           'market_data' in coin_data and isinstance(coin_data['market_data'], dict) and \
-           'circulating_supply' in coin_data['market_data']:
-            circulating_supply = coin_data['market_data']['circulating_supply']
+        circulating_supply = _get_btc_market_data().get('circulating_supply')
         
         if circulating_supply is not None:
             today_midnight_utc = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
             timestamp = int(today_midnight_utc.timestamp())
             
-            df = pd.DataFrame([{'timestamp': timestamp, 'circulating_supply': circulating_supply}])
-            store_data_incrementally(df, 'bitcoin_supply_info', pk_columns_list=['timestamp'])
+            _insert_row('bitcoin_supply_info', ('timestamp', 'circulating_supply'), (timestamp, circulating_supply))
             # print(f"Stored Bitcoin circulating supply: {circulating_supply} for {today_midnight_utc.strftime('%Y-%m-%d')}") # Less verbose
         else:
             print("Could not fetch Bitcoin circulating supply or response structure unexpected.")
@@ -450,23 +589,13 @@ def fetch_bitcoin_dominance():
     btc_mcap = None
     total_mcap = None
     try:
-        # Fetch Bitcoin market data
-        btc_response = cg.get_coin_by_id(id='bitcoin', market_data='true', sparkline='false',
-                                         community_data='false', developer_data='false', localization='false')
-        time.sleep(3) # Increased sleep for CoinGecko
-        
-        if btc_response and isinstance(btc_response, dict) and \
-           'market_data' in btc_response and isinstance(btc_response['market_data'], dict) and \
-           'market_cap' in btc_response['market_data'] and isinstance(btc_response['market_data']['market_cap'], dict) and \
-           'usd' in btc_response['market_data']['market_cap']:
-            btc_mcap = btc_response['market_data']['market_cap']['usd']
-        else:
+        # Bitcoin market data (shared with fetch_bitcoin_circulating_supply via the TTL cache)
+        btc_mcap = _get_btc_market_data().get('market_cap')
+        if btc_mcap is None:
             print("Failed to get 'usd' market cap from btc_response or unexpected structure.")
-            # print(f"DEBUG: BTC Response (type: {type(btc_response)}): {str(btc_response)[:500]}") # Keep for debugging if needed
 
         # Fetch global market data
-        global_response = cg.get_global()
-        time.sleep(3) # Increased sleep for CoinGecko
+        global_response = _coingecko(cg.get_global)
 
         # --- CORRECTED ACCESS TO total_market_cap ---
         if global_response and isinstance(global_response, dict) and \
@@ -483,9 +612,8 @@ def fetch_bitcoin_dominance():
             today_midnight_utc = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
             timestamp = int(today_midnight_utc.timestamp()) 
             
-            df = pd.DataFrame([{'timestamp': timestamp, 'dominance': dominance}])
-            store_data_incrementally(df, 'bitcoin_dominance', pk_columns_list=['timestamp'])
-            # The print message from store_data_incrementally will confirm storage
+            _insert_row('bitcoin_dominance', ('timestamp', 'dominance'), (timestamp, dominance))
+            # The print message from _insert_row will confirm storage
         elif btc_mcap is not None and total_mcap is None: # Specifically if total_mcap is the issue
              print(f"Successfully fetched BTC MCap ({btc_mcap}), but Total MCap is still None. Check API response for 'total_market_cap'.")
         else:
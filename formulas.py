@@ -2,91 +2,359 @@
 import pandas as pd
 import sqlite3
 from datetime import datetime, timedelta, timezone
+import contextlib
+import functools
+import os
+import shutil
+import threading
 import numpy as np 
+try:
+    import bottleneck as bn # Optional: C moving-window kernels, faster than pandas rolling()
+except ImportError:
+    bn = None
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+import thresholds_config as th
 
 DB_PATH = 'data/crypto_metrics.db'
+PARQUET_DIR = 'data/parquet' # Year-partitioned Parquet mirror of the calculated tables: <table>/year=YYYY/
+
+# S2F flow only depends on config constants, so it is computed once at import
+S2F_ANNUAL_FLOW_BTC = th.BLOCK_REWARD_BTC * th.BLOCKS_PER_DAY * 365.25
+
+# Halving table as sorted epoch-second edges + the reward from each edge on, for reward_for_dates
+_HALVING_EDGES = np.array([day for day, _ in th.HALVINGS], dtype='datetime64[s]').astype(np.int64)
+_HALVING_REWARDS = np.array([reward for _, reward in th.HALVINGS], dtype=float)
+
+# Serializes use of the shared connection when main.py runs the calculators on worker threads;
+# only the SQL runs under it, the pandas/NumPy work in between overlaps.
+_DB_LOCK = threading.RLock()
+
+@functools.lru_cache(maxsize=1)
+def _get_conn():
+    """Module-wide connection reused by every calculator. WAL + NORMAL keep the table rewrites
+    from fsyncing on each commit; mmap and a 64 MB page cache speed up the price history reads."""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA mmap_size=268435456')
+    conn.execute('PRAGMA cache_size=-65536')
+    return conn
+
+# --- RISK CLASSIFICATION ---
+# Risk codes shared by the dashboard: -1 = N/A, 0 = green, 1 = yellow, 2 = red.
+def classify_series(values, medium_threshold, high_threshold, low_is_good=True):
+    """Vectorized risk bucketing of a scalar or array of metric values.
+
+    With low_is_good=True, values >= high are red and >= medium are yellow. With
+    low_is_good=False the scale is inverted (<= high is red, <= medium is yellow).
+    NaN/None values map to -1.
+    """
+    values = np.asarray(values, dtype=float)
+    if low_is_good:
+        codes = np.searchsorted([medium_threshold, high_threshold], values, side='right')
+    else: # Negate so the thresholds stay ascending for searchsorted
+        codes = np.searchsorted([-medium_threshold, -high_threshold], -values, side='right')
+    return np.where(np.isnan(values), -1, codes)
+
+# metric -> (medium threshold, high threshold, low_is_good), cast once at import. The calculators
+# store risk codes from these and the dashboard classifies its live metrics with the same table.
+RISK_THRESHOLDS = {
+    'fear_greed': (float(th.FG_GREED), float(th.FG_EXTREME_GREED), True),
+    'google_trends': (float(th.GTRENDS_MEDIUM_RISK), float(th.GTRENDS_HIGH_RISK), True),
+    'pi_cycle': (float(th.PI_CYCLE_APPROACH_FACTOR), 1.0, True), # on 111DMA / (350DMA*2)
+    'wma_200': (float(th.WMA200_PRICE_RATIO_MEDIUM), float(th.WMA200_PRICE_RATIO_HIGH), True),
+    'dominance': (float(th.DOMINANCE_FROTH_MEDIUM), float(th.DOMINANCE_FROTH_HIGH), False),
+    's2f': (float(th.S2F_PRICE_DEVIATION_MEDIUM), float(th.S2F_PRICE_DEVIATION_HIGH), True),
+    'puell': (float(th.PUELL_MEDIUM_RISK), float(th.PUELL_HIGH_RISK), True),
+}
+
+def risk_codes(metric, values):
+    """int8 risk codes of a metric's values against RISK_THRESHOLDS (classify_series rules)."""
+    medium, high, low_is_good = RISK_THRESHOLDS[metric]
+    return classify_series(values, medium, high, low_is_good).astype(np.int8)
+
+def score_rows(values, medium_thresholds, high_thresholds, low_is_good):
+    """Per-row (Red, Yellow, Green) counts for a (days x metrics) array of aligned metric values.
+
+    Thresholds and low_is_good are per-metric (column) sequences; each column is bucketed by
+    classify_series, and NaN cells (code -1) are left out of all three counts.
+    """
+    values = np.asarray(values, dtype=float).reshape(len(values), -1)
+    codes = np.column_stack([classify_series(values[:, i], medium, high, bool(low))
+                             for i, (medium, high, low) in enumerate(zip(medium_thresholds, high_thresholds, low_is_good))])
+    return np.stack([(codes == level).sum(axis=1) for level in (2, 1, 0)], axis=1).astype(np.int32)
+
+def _fetch_btc_arrays(conn, since_ts=None):
+    """BTC (timestamps, prices) in timestamp order, filled from the cursor straight into int64/float64
+    arrays (NULL price -> NaN) instead of going through read_sql_query's per-cell DataFrame build."""
+    query = "SELECT timestamp, price FROM crypto_prices WHERE coin_id = 'bitcoin'"
+    params = ()
+    if since_ts is not None:
+        # Range scan on the covering idx_crypto_prices_coin_ts_price, already in timestamp order
+        query += " AND timestamp >= ?"
+        params = (since_ts,)
+    rows = conn.execute(query + " ORDER BY timestamp", params).fetchall()
+    timestamps = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    prices = np.fromiter((row[1] for row in rows), dtype=np.float64, count=len(rows))
+    return timestamps, prices
 
 def get_btc_price_data_from_db(days_history=None, end_date_dt=None):
-    conn = sqlite3.connect(DB_PATH)
-    query = "SELECT timestamp, price FROM crypto_prices WHERE coin_id = 'bitcoin' ORDER BY timestamp"
-    
+    start_timestamp = None
     if days_history:
         if end_date_dt is None:
             end_date_dt = datetime.now(timezone.utc)
         start_timestamp = int((end_date_dt - timedelta(days=days_history)).timestamp())
-        query = f"SELECT timestamp, price FROM crypto_prices WHERE coin_id = 'bitcoin' AND timestamp >= {start_timestamp} ORDER BY timestamp"
 
     try:
-        df = pd.read_sql_query(query, conn)
-    except Exception as e:
+        with _DB_LOCK:
+            timestamps, prices = _fetch_btc_arrays(_get_conn(), start_timestamp)
+    except sqlite3.Error as e:
         print(f"Error reading BTC price data from DB: {e}")
-        df = pd.DataFrame(columns=['timestamp', 'price']) # Return empty df on error
-    finally:
-        conn.close()
-
-    if not df.empty:
-        df['date'] = pd.to_datetime(df['timestamp'], unit='s', utc=True)
-        df.set_index('date', inplace=True)
-        df = df['price'].rename('close') # Assuming 'price' is the close price
-        df = df[~df.index.duplicated(keep='last')] # Ensure unique index
-    return df
-
-def calculate_pi_cycle_top():
+        timestamps, prices = np.empty(0, dtype=np.int64), np.empty(0) # Return empty series on error
+
+    index = pd.to_datetime(timestamps, unit='s', utc=True).rename('date')
+    df = pd.Series(prices, index=index, name='close') # Assuming 'price' is the close price
+    return df[~df.index.duplicated(keep='last')] # Ensure unique index
+
+def _load_btc_prices_cached(days_history=365*5):
+    """BTC closes for the last `days_history` days, read once and shared by a run's calculators.
+    Keyed on the newest stored BTC timestamp, so a new price row forces a fresh read."""
+    with _DB_LOCK:
+        max_ts = _get_conn().execute("SELECT MAX(timestamp) FROM crypto_prices WHERE coin_id = 'bitcoin'").fetchone()[0]
+    return _load_btc_prices(days_history, max_ts)
+
+@functools.lru_cache(maxsize=1)
+def _load_btc_prices(days_history, max_ts): # max_ts only keys the cache
+    return get_btc_price_data_from_db(days_history=days_history)
+
+def _btc_window(btc_df, days_history):
+    """Last `days_history` days of shared BTC closes (not copied, callers must not mutate),
+    or a DB read when no shared series was passed in."""
+    if btc_df is None:
+        return get_btc_price_data_from_db(days_history=days_history)
+    if btc_df.empty:
+        return btc_df
+    return btc_df[btc_df.index >= datetime.now(timezone.utc) - timedelta(days=days_history)]
+
+def reward_for_dates(index):
+    """Block subsidy (BTC) in effect at each timestamp of a DatetimeIndex, via one binary search
+    over the config halving dates (dates before genesis get the genesis reward)."""
+    seconds = index.values.astype('datetime64[s]').astype(np.int64)
+    return _HALVING_REWARDS[np.maximum(np.searchsorted(_HALVING_EDGES, seconds, side='right') - 1, 0)]
+
+def _weekly_last(daily):
+    """Last non-NaN value of each Monday-Sunday week (UTC calendar days), labelled with that Sunday at
+    midnight and NaN for weeks without one: resample('W-SUN').last(), done with integer week numbers
+    instead of a Grouper. Like resample, the weeks span the whole index, NaN-only edge weeks included."""
+    if daily.empty:
+        return daily
+    seconds = daily.index.values.astype('datetime64[s]').astype(np.int64)
+    week = (seconds // 86400 + 3) // 7 # 1970-01-01 was a Thursday, so +3 makes weeks start on Monday
+    values = daily.to_numpy(dtype=float)
+    finite = ~np.isnan(values) # last() skips NaN rows
+    finite_week = week[finite]
+    last_in_week = np.append(finite_week[1:] != finite_week[:-1], True)[:finite_week.size] # Index is sorted: last row before the week changes
+    weekly = np.full(week[-1] - week[0] + 1, np.nan)
+    weekly[finite_week[last_in_week] - week[0]] = values[finite][last_in_week]
+    sundays = (np.arange(week[0], week[-1] + 1) * 7 + 3) * 86400 # Monday of week w is day 7w - 3
+    return pd.Series(weekly, index=pd.to_datetime(sundays, unit='s', utc=True).rename(daily.index.name), name=daily.name)
+
+def _rolling_means(series, *windows):
+    """Trailing means of `series` for each window, NaN until the window holds `window` finite values
+    (same as rolling(min_periods=window).mean()). Without bottleneck, all windows are read off one
+    pass of running sums and finite counts instead of one pandas rolling() traversal per window."""
+    values = series.to_numpy(dtype=float)
+    if bn is None:
+        finite = np.isfinite(values)
+        sums = np.concatenate(([0.0], np.cumsum(np.where(finite, values, 0.0))))
+        counts = np.concatenate(([0], np.cumsum(finite)))
+    means = []
+    for w in windows:
+        mean = np.full(len(values), np.nan)
+        if bn is not None and len(values) >= w:
+            mean = bn.move_mean(values, window=w, min_count=w)
+        elif len(values) >= w:
+            window_counts = counts[w:] - counts[:-w]
+            mean[w - 1:] = np.where(window_counts == w, (sums[w:] - sums[:-w]) / w, np.nan)
+        means.append(pd.Series(mean, index=series.index))
+    return means
+
+# --- INCREMENTAL STORAGE FOR CALCULATED TABLES ---
+INSERT_CHUNK_ROWS = 500 # Rows per multi-VALUES INSERT; 500 x 5 columns stays well under SQLite's bound-variable limit
+
+def _last_timestamp(conn, table):
+    """Newest stored timestamp of a calculated table, or None if it is empty/missing."""
+    try:
+        with _DB_LOCK:
+            return conn.execute(f'SELECT MAX(timestamp) FROM "{table}"').fetchone()[0]
+    except sqlite3.Error:
+        return None
+
+def _history_days(conn, table, window_days, full_rebuild):
+    """Days of BTC prices a calculator needs: its rolling window plus the gap since its last stored row.
+    Returns (days, last_ts); last_ts is None when the whole table has to be (re)built."""
+    last_ts = None if full_rebuild else _last_timestamp(conn, table)
+    if last_ts is None:
+        return window_days, None
+    days_since_last = int((datetime.now(timezone.utc).timestamp() - last_ts) // 86400) + 1
+    return window_days + days_since_last, last_ts
+
+def _store_calculated(conn, df, table, last_ts):
+    """INSERT OR REPLACE calculator rows. Incremental runs (last_ts set) only send rows from last_ts on;
+    the last stored row is rewritten since it may have come from a partial day/week. Without last_ts
+    the table is cleared first (full rebuild), keeping its schema rather than dropping it. REPLACE dedupes
+    on the timestamp PK (or, for legacy tables without one, the unique index data_fetcher.init_db adds).
+    Commits on its own unless the caller already opened a transaction (main.py batches all calculators)."""
+    if last_ts is not None:
+        df = df[df['timestamp'] >= last_ts]
+    columns_sql = ", ".join(f'"{col}"' for col in df.columns)
+    row_sql = "(" + ", ".join("?" * len(df.columns)) + ")"
+    n_cols = len(df.columns)
+    values = df.astype(object).to_numpy().ravel() # Row-major flat list of Python scalars for binding
+    with _DB_LOCK: # Writers from parallel calculators go one at a time
+        owns_transaction = not conn.in_transaction
+        with (conn if owns_transaction else contextlib.nullcontext()):
+            if last_ts is None:
+                conn.execute(f'DELETE FROM "{table}"')
+            for start in range(0, len(df), INSERT_CHUNK_ROWS): # One multi-row statement per chunk instead of one per row
+                n_rows = min(INSERT_CHUNK_ROWS, len(df) - start)
+                conn.execute(f'INSERT OR REPLACE INTO "{table}" ({columns_sql}) VALUES {", ".join([row_sql] * n_rows)}',
+                             values[start * n_cols:(start + n_rows) * n_cols].tolist())
+        # Full rebuilds redo every partition; incremental runs only the years they wrote
+        years = [None] if last_ts is None else _years_of(df['timestamp'].to_numpy())
+        _PARQUET_PENDING.update((table, year) for year in years)
+    if owns_transaction: # Otherwise the caller flushes after its commit
+        flush_parquet_mirror(conn)
+    return len(df)
+
+# --- PARQUET MIRROR ---
+_PARQUET_PENDING = set() # (table, year or None for all years) partitions to refresh from SQLite
+
+def _years_of(timestamps):
+    return (np.unique(np.asarray(timestamps, dtype='datetime64[s]').astype('datetime64[Y]')).astype(np.int64) + 1970).tolist()
+
+def _write_parquet_year(conn, table, year):
+    start = int(datetime(year, 1, 1, tzinfo=timezone.utc).timestamp())
+    end = int(datetime(year + 1, 1, 1, tzinfo=timezone.utc).timestamp())
+    with _DB_LOCK:
+        year_df = pd.read_sql_query(f'SELECT * FROM "{table}" WHERE timestamp >= ? AND timestamp < ? ORDER BY timestamp',
+                                    conn, params=(start, end))
+    partition_dir = os.path.join(PARQUET_DIR, table, f'year={year}')
+    if year_df.empty:
+        shutil.rmtree(partition_dir, ignore_errors=True)
+        return
+    os.makedirs(partition_dir, exist_ok=True)
+    part_path = os.path.join(partition_dir, 'part-0.parquet')
+    pq.write_table(pa.Table.from_pandas(year_df, preserve_index=False), part_path + '.tmp', compression='zstd')
+    os.replace(part_path + '.tmp', part_path) # Readers never see a half-written file
+
+def flush_parquet_mirror(conn=None):
+    """Re-exports the pending year partitions from committed SQLite rows, so the mirror never holds
+    rolled-back data. Incremental runs rewrite only the years they touched (normally the current one);
+    full rebuilds, which includes every S2F recalculation, rewrite all of a table's years. A table
+    without a mirror yet is exported in full on its first flush."""
+    if pq is None: # pyarrow not installed: SQLite stays the only copy
+        _PARQUET_PENDING.clear()
+        return
+    conn = conn or _get_conn()
+    while _PARQUET_PENDING:
+        table, year = _PARQUET_PENDING.pop()
+        table_dir = os.path.join(PARQUET_DIR, table)
+        try:
+            if year is None or not os.path.isdir(table_dir):
+                with _DB_LOCK:
+                    table_ts = conn.execute(f'SELECT MIN(timestamp), MAX(timestamp) FROM "{table}"').fetchone()
+                years = [] if table_ts[0] is None else list(range(_years_of([table_ts[0]])[0], _years_of([table_ts[1]])[0] + 1))
+                stale = set(os.listdir(table_dir) if os.path.isdir(table_dir) else ()) - {f'year={y}' for y in years}
+                for partition in stale: # Years the rebuilt table no longer has
+                    shutil.rmtree(os.path.join(table_dir, partition), ignore_errors=True)
+            else:
+                years = [year]
+            for partition_year in years:
+                _write_parquet_year(conn, table, partition_year)
+        except Exception as e:
+            print(f"Error writing Parquet mirror for {table}: {e}")
+
+def read_parquet_history(table, columns, since_ts=None):
+    """`timestamp` plus `columns` of a calculated table from its Parquet mirror, in timestamp order and
+    from since_ts on (year partitions before it are never opened). None when pyarrow or the mirror
+    is missing, so callers fall back to SQLite."""
+    table_dir = os.path.join(PARQUET_DIR, table)
+    if pq is None or not os.path.isdir(table_dir):
+        return None
+    filters = None
+    if since_ts is not None:
+        filters = [('year', '>=', _years_of([since_ts])[0]), ('timestamp', '>=', since_ts)]
+    history = pq.read_table(table_dir, columns=['timestamp', *columns], filters=filters, partitioning='hive')
+    return history.sort_by('timestamp').to_pandas() # Partition files are read in directory order
+
+def _pi_cycle_kernel(prices, short_window=111, long_window=350):
+    """Pi Cycle numeric core on a float price array: (sma_short, 2 * sma_long, crossed, valid).
+    Both SMAs come from one shared rolling pass; valid marks rows where both are warmed up
+    and crossed is only True on valid rows."""
+    sma_short, sma_long = (mean.to_numpy() for mean in _rolling_means(pd.Series(prices), short_window, long_window))
+    sma_long_doubled = sma_long * 2.0
+    valid = ~(np.isnan(sma_short) | np.isnan(sma_long_doubled))
+    crossed = valid & (np.where(valid, sma_short, 0.0) >= np.where(valid, sma_long_doubled, 0.0))
+    return sma_short, sma_long_doubled, crossed, valid
+
+def calculate_pi_cycle_top(full_rebuild=False, btc_df=None):
     print("Calculating Pi Cycle Top...")
+    conn = _get_conn()
     # Need at least 350 days of data for the longer MA. Fetch a bit more for buffer.
-    btc_df = get_btc_price_data_from_db(days_history=400) 
+    days_history, last_ts = _history_days(conn, 'pi_cycle_data', 400, full_rebuild)
+    btc_df = _btc_window(btc_df, days_history) 
     if btc_df.empty or len(btc_df) < 350:
         print(f"Not enough Bitcoin price data (need 350, have {len(btc_df)}) to calculate Pi Cycle Top.")
         return
 
-    pi_df = pd.DataFrame(index=btc_df.index)
-    pi_df['btc_price'] = btc_df
-
-    pi_df['sma_111'] = btc_df.rolling(window=111, min_periods=111).mean()
-    pi_df['sma_350_doubled'] = btc_df.rolling(window=350, min_periods=350).mean() * 2
-    
-    pi_df['signal'] = 'Neutral'
-    if 'sma_111' in pi_df.columns and 'sma_350_doubled' in pi_df.columns: # Ensure MAs were calculated
-        # Condition for "High Risk (Crossed)"
-        condition_crossed = pi_df['sma_111'] >= pi_df['sma_350_doubled']
-        pi_df.loc[condition_crossed, 'signal'] = 'High Risk (111DMA >= 350DMA*2 - CROSSED)'
-
-        # Condition for "Approaching" (only if not already crossed)
-        # This condition makes more sense if sma_111 has not yet crossed but is close.
-        # For simplicity, the dashboard can handle the "approaching" visual if sma_111 is < sma_350_doubled but close.
-        # The 'signal' column will mainly reflect the crossed state.
-    
-    pi_df.dropna(subset=['sma_111', 'sma_350_doubled'], inplace=True) # Only keep rows where MAs are valid
-    if pi_df.empty:
+    sma_111, sma_350_doubled, crossed, valid = _pi_cycle_kernel(btc_df.to_numpy(dtype=float))
+    if not valid.any():
         print("Pi Cycle DataFrame is empty after dropping NA from MAs.")
         return
 
-    pi_df.reset_index(inplace=True)
-    pi_df['timestamp'] = pi_df['date'].apply(lambda x: int(x.timestamp()))
-    pi_df = pi_df[['timestamp', 'btc_price', 'sma_111', 'sma_350_doubled', 'signal']]
+    # Only rows where both MAs are valid, built straight from the kernel's arrays
+    pi_df = pd.DataFrame({
+        'timestamp': btc_df.index.values[valid].astype('datetime64[s]').astype(np.int64), # Vectorized epoch seconds
+        'btc_price': btc_df.to_numpy()[valid],
+        'sma_111': sma_111[valid],
+        'sma_350_doubled': sma_350_doubled[valid],
+        # "High Risk (Crossed)" where 111DMA >= 350DMA*2, else Neutral
+        'signal': np.where(crossed[valid], 'High Risk (111DMA >= 350DMA*2 - CROSSED)', 'Neutral'),
+        'risk_code': risk_codes('pi_cycle', sma_111[valid] / sma_350_doubled[valid]), # Approaching / crossed
+    })
+    # Condition for "Approaching" (only if not already crossed)
+    # This condition makes more sense if sma_111 has not yet crossed but is close.
+    # For simplicity, the dashboard can handle the "approaching" visual if sma_111 is < sma_350_doubled but close.
+    # The 'signal' column will mainly reflect the crossed state.
     
-    conn = sqlite3.connect(DB_PATH)
-    pi_df.to_sql('pi_cycle_data', conn, if_exists='replace', index=False) # Replace as it's recalculated fully
-    conn.close()
-    print("Pi Cycle Top data calculated and stored.")
+    rows_written = _store_calculated(conn, pi_df, 'pi_cycle_data', last_ts)
+    print(f"Pi Cycle Top data calculated and stored ({rows_written} rows).")
 
 
-def calculate_200wma():
+def calculate_200wma(full_rebuild=False, btc_df=None):
     print("Calculating 200 Week Moving Average...")
+    conn = _get_conn()
     # Need at least 200 weeks * 7 days/week = 1400 days. Fetch a bit more.
-    btc_daily_df = get_btc_price_data_from_db(days_history=1500) 
+    days_history, last_ts = _history_days(conn, 'wma_200_data', 1500, full_rebuild)
+    btc_daily_df = _btc_window(btc_df, days_history) 
     if btc_daily_df.empty or len(btc_daily_df) < 1400: # Need enough daily points for weekly resampling
         print(f"Not enough Bitcoin daily price data (need ~1400, have {len(btc_daily_df)}) for 200WMA.")
         return
 
-    btc_weekly_df = btc_daily_df.resample('W-SUN').last() # Week ending on Sunday
+    btc_weekly_df = _weekly_last(btc_daily_df) # Week ending on Sunday
     if btc_weekly_df.empty or len(btc_weekly_df) < 200:
         print(f"Not enough weekly data points (need 200, have {len(btc_weekly_df)}) after resampling for 200WMA.")
         return
 
     wma_df = pd.DataFrame(index=btc_weekly_df.index)
     wma_df['btc_price'] = btc_weekly_df # This is weekly closing price
-    wma_df['wma_200'] = btc_weekly_df.rolling(window=200, min_periods=200).mean()
+    wma_df['wma_200'] = _rolling_means(btc_weekly_df, 200)[0]
     
     wma_df.dropna(subset=['wma_200'], inplace=True) # Only keep rows where 200WMA is valid
     if wma_df.empty:
@@ -94,55 +362,38 @@ def calculate_200wma():
         return
         
     wma_df.reset_index(inplace=True)
-    wma_df['timestamp'] = wma_df['date'].apply(lambda x: int(x.timestamp()))
+    wma_df['timestamp'] = wma_df['date'].values.astype('datetime64[s]').astype(np.int64) # Vectorized epoch seconds
     # Ensure correct columns are selected for storage
-    wma_df = wma_df[['timestamp', 'btc_price', 'wma_200']]
+    wma_df['risk_code'] = risk_codes('wma_200', wma_df['btc_price'] / wma_df['wma_200'])
+    wma_df = wma_df[['timestamp', 'btc_price', 'wma_200', 'risk_code']]
 
 
-    conn = sqlite3.connect(DB_PATH)
-    wma_df.to_sql('wma_200_data', conn, if_exists='replace', index=False) # Replace, recalculated fully
-    conn.close()
-    print("200WMA data calculated and stored.")
+    rows_written = _store_calculated(conn, wma_df, 'wma_200_data', last_ts)
+    print(f"200WMA data calculated and stored ({rows_written} rows).")
 
-def calculate_s2f_model():
+def calculate_s2f_model(btc_df=None):
     print("Calculating Stock-to-Flow Model...")
-    # Fetch a good range of price history for context if plotting S2F against price
-    btc_df = get_btc_price_data_from_db(days_history=365*5) # 5 years of price data
-    if btc_df.empty:
-        print("No Bitcoin price data for S2F calculations.")
-        return
-
     current_circulating_supply = None
-    conn_supply = sqlite3.connect(DB_PATH)
+    conn = _get_conn()
     try:
-        supply_df = pd.read_sql_query("SELECT circulating_supply FROM bitcoin_supply_info ORDER BY timestamp DESC LIMIT 1", conn_supply)
-        if not supply_df.empty and supply_df.iloc[0]['circulating_supply'] is not None:
-            current_circulating_supply = supply_df.iloc[0]['circulating_supply']
+        with _DB_LOCK:
+            supply_row = conn.execute("SELECT circulating_supply FROM bitcoin_supply_info ORDER BY timestamp DESC LIMIT 1").fetchone()
+        if supply_row is not None and supply_row[0] is not None:
+            current_circulating_supply = supply_row[0]
         else:
             print("Circulating supply not found in database for S2F. Please run data_fetcher.")
             return
     except Exception as e:
         print(f"Error reading circulating supply from DB for S2F: {e}")
         return
-    finally:
-        conn_supply.close()
     
     if current_circulating_supply is None: return
 
 
     # S2F Parameters - these need to be accurate and potentially dynamic for full historical accuracy
-    # For this version, we use current block reward and assume it for S2F ratio calculation
+    # For this version, we use current block reward (thresholds_config) and assume it for S2F ratio calculation
     # A truly historical S2F model would adjust block reward based on past halving dates.
-    # Halving dates (approximate, for future refinement if needed):
-    # H1: 2012-11-28 (50 -> 25)
-    # H2: 2016-07-09 (25 -> 12.5)
-    # H3: 2020-05-11 (12.5 -> 6.25)
-    # H4: 2024-04-19 (6.25 -> 3.125)
-    current_block_reward_btc = 3.125 
-    blocks_per_day_approx = (24 * 60) / 10 # Assuming ~10 min block time = 144
-    annual_flow_btc = current_block_reward_btc * blocks_per_day_approx * 365.25
-
-    s2f_ratio = current_circulating_supply / annual_flow_btc if annual_flow_btc > 0 else 0
+    s2f_ratio = current_circulating_supply / S2F_ANNUAL_FLOW_BTC if S2F_ANNUAL_FLOW_BTC > 0 else 0
     
     # PlanB's S2F Model Price (one common formulation): Price = a * (S2F_Ratio ^ n)
     # Parameters 'a' and 'n' are derived from regression on historical data.
@@ -175,41 +426,50 @@ def calculate_s2f_model():
     else:
         s2f_model_price_value = 0
 
-    s2f_data_list = []
-    for date_index, btc_close_price in btc_df.items():
-        s2f_data_list.append({
-            'timestamp': int(date_index.timestamp()),
-            'btc_price': btc_close_price,
-            's2f_ratio': s2f_ratio, # Using current S2F ratio across the historical price chart for simplicity
-            's2f_price_model': s2f_model_price_value # Using current model price across history
-        })
-        
-    if s2f_data_list:
-        s2f_df_to_store = pd.DataFrame(s2f_data_list)
-        conn_s2f = sqlite3.connect(DB_PATH) 
-        s2f_df_to_store.to_sql('s2f_data', conn_s2f, if_exists='replace', index=False) # Replace, recalculated fully
-        conn_s2f.close()
+    # No new BTC price row and the same supply -> the stored table is already current
+    with _DB_LOCK:
+        last_s2f_row = conn.execute("SELECT timestamp, s2f_ratio FROM s2f_data ORDER BY timestamp DESC LIMIT 1").fetchone()
+        latest_btc_ts = conn.execute("SELECT MAX(timestamp) FROM crypto_prices WHERE coin_id = 'bitcoin'").fetchone()[0]
+    if last_s2f_row is not None and last_s2f_row[0] == latest_btc_ts and last_s2f_row[1] == s2f_ratio:
+        print("S2F Model data is up to date (no new price or supply data).")
+        return
+
+    # Fetch a good range of price history for context if plotting S2F against price
+    btc_df = _btc_window(btc_df, 365*5) # 5 years of price data
+    if btc_df.empty:
+        print("No Bitcoin price data for S2F calculations.")
+        return
+
+    s2f_df_to_store = pd.DataFrame({
+        'timestamp': btc_df.index.values.astype('datetime64[s]').astype(np.int64),
+        'btc_price': btc_df.values,
+        's2f_ratio': s2f_ratio, # Using current S2F ratio across the historical price chart for simplicity
+        's2f_price_model': s2f_model_price_value, # Using current model price across history
+        'risk_code': risk_codes('s2f', btc_df.values / s2f_model_price_value if s2f_model_price_value > 0
+                                else np.full(len(btc_df), np.nan)), # Price / model deviation
+    }) # Scalars broadcast to the price column's length
+
+    if not s2f_df_to_store.empty:
+        _store_calculated(conn, s2f_df_to_store, 's2f_data', None) # Recalculated fully; to_sql would commit mid-batch
         print(f"S2F Model data calculated (current S2F ratio: {s2f_ratio:.2f}, model price: ${s2f_model_price_value:,.2f}) and stored.")
 
-def calculate_puell_multiple_alternative():
+def calculate_puell_multiple_alternative(full_rebuild=False, btc_df=None):
     print("Calculating Puell Multiple (Alternative)...")
+    conn = _get_conn()
     # Need at least 365 days for the MA. Fetch a bit more.
-    btc_df = get_btc_price_data_from_db(days_history=400) 
+    days_history, last_ts = _history_days(conn, 'puell_multiple_calculated', 400, full_rebuild)
+    btc_df = _btc_window(btc_df, days_history) 
     if btc_df.empty or len(btc_df) < 365:
         print(f"Not enough Bitcoin price data (need 365 days, have {len(btc_df)}) to calculate Puell Multiple accurately.")
         return
 
-    # Current block reward (post-April 2024 halving) - for historical accuracy, this needs to change based on date.
-    # For this simplified "alternative calculation", we'll use the current reward.
-    current_block_reward_btc = 3.125  
-    blocks_per_day_approx = 144 
-    
-    daily_issuance_btc = current_block_reward_btc * blocks_per_day_approx
+    # Block reward in effect on each day (halving-aware), so the 365d MA spans halvings correctly
+    daily_issuance_btc = reward_for_dates(btc_df.index) * th.BLOCKS_PER_DAY
     
     puell_df = pd.DataFrame(index=btc_df.index)
     puell_df['btc_price'] = btc_df
     puell_df['daily_issuance_usd'] = daily_issuance_btc * puell_df['btc_price']
-    puell_df['daily_issuance_usd_365d_ma'] = puell_df['daily_issuance_usd'].rolling(window=365, min_periods=365).mean()
+    puell_df['daily_issuance_usd_365d_ma'] = _rolling_means(puell_df['daily_issuance_usd'], 365)[0]
     puell_df['puell_multiple'] = puell_df['daily_issuance_usd'] / puell_df['daily_issuance_usd_365d_ma']
 
     puell_df.dropna(subset=['puell_multiple'], inplace=True) # Only keep rows where Puell is valid
@@ -218,33 +478,33 @@ def calculate_puell_multiple_alternative():
         return
 
     puell_df.reset_index(inplace=True)
-    puell_df['timestamp'] = puell_df['date'].apply(lambda x: int(x.timestamp()))
-    puell_df = puell_df[['timestamp', 'btc_price', 'daily_issuance_usd', 'daily_issuance_usd_365d_ma', 'puell_multiple']]
+    puell_df['timestamp'] = puell_df['date'].values.astype('datetime64[s]').astype(np.int64) # Vectorized epoch seconds
+    puell_df['risk_code'] = risk_codes('puell', puell_df['puell_multiple'])
+    puell_df = puell_df[['timestamp', 'btc_price', 'daily_issuance_usd', 'daily_issuance_usd_365d_ma', 'puell_multiple', 'risk_code']]
 
-    conn = sqlite3.connect(DB_PATH)
-    puell_df.to_sql('puell_multiple_calculated', conn, if_exists='replace', index=False) # Replace, recalculated fully
-    conn.close()
-    print("Puell Multiple (Alternative) data calculated and stored.")
+    rows_written = _store_calculated(conn, puell_df, 'puell_multiple_calculated', last_ts)
+    print(f"Puell Multiple (Alternative) data calculated and stored ({rows_written} rows).")
 
 
 if __name__ == "__main__":
     print(f"[{datetime.now()}] Running formulas.py calculations (direct run)...")
-    # Ensure DB is initialized (though data_fetcher should do this)
+    # Ensure DB is initialized and migrated (adds risk_code to older tables), as main.py does
     # And price data is fetched before calculating
-    conn_check = sqlite3.connect(DB_PATH)
+    import data_fetcher # Only the direct run needs it; the calculators themselves don't fetch
+    data_fetcher.init_db()
     try:
-        btc_prices_exist_check = pd.read_sql_query("SELECT COUNT(*) as count FROM crypto_prices WHERE coin_id = 'bitcoin'", conn_check).iloc[0,0] > 0
-    except pd.io.sql.DatabaseError: # Table doesn't exist
+        # Stops at the first index entry instead of counting every BTC row
+        btc_prices_exist_check = _get_conn().execute("SELECT 1 FROM crypto_prices WHERE coin_id = 'bitcoin' LIMIT 1").fetchone() is not None
+    except sqlite3.OperationalError: # Table doesn't exist
         btc_prices_exist_check = False
-    finally:
-        conn_check.close()
 
     if not btc_prices_exist_check:
         print("Bitcoin price data not found in DB. Please run data_fetcher.py first.")
     else:
         print("Calculating derived metrics...")
-        calculate_pi_cycle_top()
-        calculate_200wma()
-        calculate_s2f_model() 
-        calculate_puell_multiple_alternative()
+        btc_df = _load_btc_prices_cached() # One read shared by all four calculators
+        calculate_pi_cycle_top(btc_df=btc_df)
+        calculate_200wma(btc_df=btc_df)
+        calculate_s2f_model(btc_df=btc_df) 
+        calculate_puell_multiple_alternative(btc_df=btc_df)
         print(f"[{datetime.now()}] Derived metrics calculation tasks (direct run) finished.")
\ No newline at end of file
@@ -1,11 +1,22 @@
 # main.py
-import schedule
+import argparse
 import time
 import datetime # For logging timestamp with full module name
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import data_fetcher 
 import formulas   
 
-def run_daily_tasks():
+DAILY_RUN_HOUR = 1 # Local time of the daily run (01:00)
+
+def next_run_time(now=None):
+    """Next DAILY_RUN_HOUR:00 strictly after `now` (local time)."""
+    now = now or datetime.datetime.now()
+    next_run = now.replace(hour=DAILY_RUN_HOUR, minute=0, second=0, microsecond=0)
+    if next_run <= now:
+        next_run += datetime.timedelta(days=1)
+    return next_run
+
+def run_daily_tasks(full_rebuild=False):
     current_time_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     print(f"[{current_time_str}] Starting daily data update and calculations...")
     
@@ -22,10 +33,21 @@ def run_daily_tasks():
 
         # Step 2: Calculate derived metrics using the latest data in the DB
         print(f"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] --- Data fetching complete. Running formula calculations ---")
-        formulas.calculate_pi_cycle_top()
-        formulas.calculate_200wma()
-        formulas.calculate_s2f_model()
-        formulas.calculate_puell_multiple_alternative()
+        btc_df = formulas._load_btc_prices_cached() # One 5-year price read shared by all four calculators
+        conn = formulas._get_conn()
+        with conn: # One transaction for all four calculators, committed once (rolled back on error)
+            conn.execute("BEGIN")
+            # Independent calculators run concurrently; formulas serializes their SQL on the shared connection
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                futures = [
+                    executor.submit(formulas.calculate_pi_cycle_top, full_rebuild=full_rebuild, btc_df=btc_df),
+                    executor.submit(formulas.calculate_200wma, full_rebuild=full_rebuild, btc_df=btc_df),
+                    executor.submit(formulas.calculate_s2f_model, btc_df=btc_df),
+                    executor.submit(formulas.calculate_puell_multiple_alternative, full_rebuild=full_rebuild, btc_df=btc_df),
+                ]
+                for future in as_completed(futures):
+                    future.result() # Re-raise a calculator's exception so the transaction rolls back
+        formulas.flush_parquet_mirror() # Export the partitions the batch touched, now that it is committed
         
         current_time_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         print(f"[{current_time_str}] --- Daily tasks finished successfully. ---")
@@ -37,6 +59,13 @@ def run_daily_tasks():
         traceback.print_exc() # Print full traceback for debugging errors in tasks
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fetch data and calculate metrics daily.")
+    parser.add_argument('--full-rebuild', action='store_true',
+                        help="Recalculate derived metric tables from full history on the initial run (e.g. after a schema change).")
+    parser.add_argument('--once', action='store_true',
+                        help="Run a single update cycle and exit (for a systemd timer or cron job).")
+    args = parser.parse_args()
+
     print("Initializing database schema if it doesn't exist...")
     data_fetcher.init_db() 
     
@@ -45,15 +74,15 @@ if __name__ == "__main__":
     
     # Option 1: Run once immediately on start, then schedule
     print("An initial data fetch and calculation cycle will run now.")
-    run_daily_tasks() 
+    run_daily_tasks(full_rebuild=args.full_rebuild) 
     
-    # Option 2: Just schedule it (it will run at the next scheduled time)
-    # print("Tasks scheduled. Will run at the configured time.")
-
-    schedule.every().day.at("01:00").do(run_daily_tasks) 
-    current_time_main_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{current_time_main_str}] Daily tasks scheduled. Next run for most tasks is around: {schedule.next_run()}")
+    if args.once:
+        raise SystemExit(0)
 
+    # Sleep straight through to the next run: one wakeup per day instead of polling every 30s
     while True:
-        schedule.run_pending()
-        time.sleep(30)
\ No newline at end of file
+        next_run = next_run_time()
+        current_time_main_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print(f"[{current_time_main_str}] Daily tasks scheduled. Next run at: {next_run}")
+        time.sleep(max(0.0, (next_run - datetime.datetime.now()).total_seconds()))
+        run_daily_tasks()
\ No newline at end of file
@@ -0,0 +1,32 @@
+import sqlite3
+
+import pytest
+
+data_fetcher = pytest.importorskip("data_fetcher")
+
+
+def test_arrow_reader_sees_rows_committed_after_first_fetch(tmp_path):
+    pytest.importorskip("adbc_driver_sqlite.dbapi")
+    db_path = str(tmp_path / "metrics.db")
+    writer = sqlite3.connect(db_path)
+    writer.execute("PRAGMA journal_mode=WAL")
+    writer.execute("CREATE TABLE pi_cycle_data (timestamp INTEGER PRIMARY KEY, sma_111 REAL)")
+    with writer:
+        writer.execute("INSERT INTO pi_cycle_data VALUES (1, 1.0)")
+
+    reader = data_fetcher.open_arrow_reader(db_path)
+
+    def fetch_rows():
+        cur = reader.cursor()
+        try:
+            cur.execute("SELECT timestamp FROM pi_cycle_data ORDER BY timestamp")
+            return cur.fetch_arrow_table().column("timestamp").to_pylist()
+        finally:
+            cur.close()
+
+    assert fetch_rows() == [1]
+    with writer:
+        writer.execute("INSERT INTO pi_cycle_data VALUES (2, 2.0)")
+    assert fetch_rows() == [1, 2]
+    reader.close()
+    writer.close()
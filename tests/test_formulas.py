@@ -0,0 +1,71 @@
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+formulas = pytest.importorskip("formulas")
+
+
+def _expected_weekly(daily):
+    return daily.resample('W-SUN').last()
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_weekly_last_matches_resample_with_nan_and_gap_weeks(seed):
+    rng = np.random.default_rng(seed)
+    index = pd.date_range('2023-01-01', periods=24 * 120, freq='h', tz='UTC', name='date')
+    keep = np.sort(rng.choice(len(index), size=len(index) // 10, replace=False))
+    keep = keep[(keep < 24 * 40) | (keep >= 24 * 60)] # Gap of whole weeks with no rows at all
+    values = rng.normal(30000, 1000, len(keep))
+    values[rng.random(len(keep)) < 0.2] = np.nan
+    values[:30] = np.nan # NaN-only rows at the start...
+    values[-30:] = np.nan # ...and at the end
+    daily = pd.Series(values, index=index[keep], name='close')
+
+    pd.testing.assert_series_equal(formulas._weekly_last(daily), _expected_weekly(daily), check_freq=False)
+
+
+def test_weekly_last_keeps_all_of_sunday_in_its_week():
+    index = pd.to_datetime(['2024-01-07 00:00', '2024-01-07 12:00', '2024-01-08 00:00'], utc=True).rename('date')
+    daily = pd.Series([1.0, 2.0, np.nan], index=index, name='close')
+
+    pd.testing.assert_series_equal(formulas._weekly_last(daily), _expected_weekly(daily), check_freq=False)
+
+
+def test_weekly_last_all_nan_gives_nan_weeks():
+    index = pd.date_range('2024-01-01', periods=15, freq='D', tz='UTC', name='date')
+    daily = pd.Series(np.nan, index=index, name='close')
+
+    pd.testing.assert_series_equal(formulas._weekly_last(daily), _expected_weekly(daily), check_freq=False)
+
+
+def _puell_rows(start, periods):
+    timestamps = pd.date_range(start, periods=periods, freq='D', tz='UTC').values.astype('datetime64[s]').astype(np.int64)
+    return pd.DataFrame({'timestamp': timestamps, 'puell_multiple': np.linspace(0.5, 2.0, periods)})
+
+
+def test_parquet_mirror_follows_committed_sqlite_rows(tmp_path, monkeypatch):
+    pytest.importorskip("pyarrow.parquet")
+    monkeypatch.setattr(formulas, 'PARQUET_DIR', str(tmp_path / 'parquet'))
+    conn = sqlite3.connect(str(tmp_path / 'metrics.db'))
+    conn.execute("CREATE TABLE puell_multiple_calculated (timestamp INTEGER PRIMARY KEY, puell_multiple REAL)")
+
+    # Incremental write into a table with no mirror yet: every stored year is exported, not just the new one
+    formulas._store_calculated(conn, _puell_rows('2023-12-01', 40), 'puell_multiple_calculated', None)
+    new_rows = _puell_rows('2024-01-05', 30)
+    formulas._store_calculated(conn, new_rows, 'puell_multiple_calculated', int(new_rows['timestamp'].iloc[0]))
+    assert sorted(os.listdir(tmp_path / 'parquet' / 'puell_multiple_calculated')) == ['year=2023', 'year=2024']
+
+    stored = pd.read_sql_query("SELECT timestamp, puell_multiple FROM puell_multiple_calculated ORDER BY timestamp", conn)
+    pd.testing.assert_frame_equal(formulas.read_parquet_history('puell_multiple_calculated', ['puell_multiple']), stored)
+
+    since_ts = int(pd.Timestamp('2024-01-20', tz='UTC').timestamp())
+    recent = formulas.read_parquet_history('puell_multiple_calculated', ['puell_multiple'], since_ts)
+    pd.testing.assert_frame_equal(recent, stored[stored['timestamp'] >= since_ts].reset_index(drop=True))
+
+    # A full rebuild that no longer covers 2023 drops that partition
+    formulas._store_calculated(conn, _puell_rows('2024-02-01', 10), 'puell_multiple_calculated', None)
+    assert os.listdir(tmp_path / 'parquet' / 'puell_multiple_calculated') == ['year=2024']
+    conn.close()
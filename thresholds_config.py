@@ -56,6 +56,19 @@ PUELL_HIGH_RISK = 3.0       # Red: High Risk (Miners exceptionally profitable vs
 PUELL_MEDIUM_RISK = 1.8     # Yellow: Medium Risk (Miners significantly profitable)
 # Green: < 1.8 (Miner profitability not indicating extreme market heat)
 
+# --- Issuance Constants (used by the S2F and Puell calculations) ---
+# Block subsidy in effect from each date (UTC, approximate halving days), genesis block first.
+# Add the next halving here when it happens (~2028).
+HALVINGS = [
+    ('2009-01-03', 50.0),
+    ('2012-11-28', 25.0),
+    ('2016-07-09', 12.5),
+    ('2020-05-11', 6.25),
+    ('2024-04-19', 3.125),
+]
+BLOCK_REWARD_BTC = HALVINGS[-1][1] # Current subsidy
+BLOCKS_PER_DAY = (24 * 60) / 10 # ~10 min block time = 144
+
 # --- General Overall Risk Assessment ---
 # Thresholds for how many individual Red/Yellow signals trigger an overall market warning.
 # These are subjective and depend on how many indicators you actively use.